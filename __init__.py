@@ -72,3 +72,14 @@ class ExtractMobiAction(InterfaceActionBase):
         :param config_widget: The widget returned by :meth:`config_widget`.
         '''
         config_widget.save_settings()
+
+    def cli_main(self, args):
+        '''
+        Batch process a calibre library without the GUI, e.g.:
+
+            calibre-debug -r "KindleUnpack - The Plugin" -- --library ~/Books --operation epub --jobs 4
+
+        Run with --help for all the options.
+        '''
+        from calibre_plugins.kindleunpack_plugin.cli import main
+        return main(args)
@@ -5,9 +5,10 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__   = 'GPL v3'
 __docformat__ = 'restructuredtext en'
 
-import os
+import traceback
 
 from functools import partial
+from threading import Thread
 
 try:
     from qt.core import QMenu, QToolButton
@@ -17,17 +18,22 @@ except ImportError:
     except ImportError:
         from PyQt4.Qt import QMenu, QToolButton
 
-from calibre.gui2 import choose_dir, info_dialog, open_local_file
+from calibre.gui2 import choose_dir, info_dialog, question_dialog, open_local_file, Dispatcher
 from calibre.gui2.actions import InterfaceAction
 
-from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre_plugins.kindleunpack_plugin.__init__ import (PLUGIN_NAME,
                                 PLUGIN_VERSION, PLUGIN_DESCRIPTION)
 import calibre_plugins.kindleunpack_plugin.config as cfg
-from calibre_plugins.kindleunpack_plugin.dialogs import ProgressDialog, ResultsSummaryDialog
-# from calibre_plugins.kindleunpack_plugin.mobi_stuff import mobiProcessor
-from calibre_plugins.kindleunpack_plugin.utilities import (get_icon, KindleFormats, set_plugin_icon_resources,
-                                showErrorDlg, create_menu_item, create_menu_action_unique, build_log)
+from calibre_plugins.kindleunpack_plugin.dialogs import AnalysisDialog, ProgressDialog, ResultsSummaryDialog
+from calibre_plugins.kindleunpack_plugin.jobs import create_extractor
+from calibre_plugins.kindleunpack_plugin.api import KINDLE_FORMATS, extracted_book
+from calibre_plugins.kindleunpack_plugin.utilities import (get_icon, KindleFormats, SelectionFormats, set_plugin_icon_resources,
+                                showErrorDlg, create_menu_item, create_menu_action_unique, build_log, OUTCOMES)
+
+# Kindle format a multiple book action works on -> (the mobiProcessor attribute a book
+# needs, the format it produces, what the books are called, what's being done to them).
+BATCH_ACTIONS = {'AZW3': ('isKF8', 'EPUB', 'KF8 books', 'Unpacking ePubs from'),
+                 'AZW4': ('isPrintReplica', 'PDF', 'Print Replica books', 'Extracting PDFs from')}
 
 
 class InterfacePlugin(InterfaceAction):
@@ -46,15 +52,99 @@ class InterfacePlugin(InterfaceAction):
 
         self.qaction.setMenu(self.menu)
         self.qaction.setIcon(get_icon(cfg.PLUGIN_ICONS[0]))
+        # Identifies the selection the single book menu was last built (or is being built) for.
+        self.menu_key = None
+        # The signatures of that book's kindle format files when the menu was built.
+        # None while the formats are still being probed.
+        self.menu_signatures = None
+        # Lets the inspection thread hand its results back to the GUI thread.
+        self.inspection_done = Dispatcher(self.inspected_single_book)
         # Setup hooks so that we only enable the relevant submenus for available formats for the selection.
         self.menu.aboutToShow.connect(self.about_to_show_menu)
 
     def about_to_show_menu(self):
         book_ids = self.gui.library_view.get_selected_ids()
         if len(book_ids) > 1:
+            self.menu_key = None
             self.build_multiple_book_menus(book_ids)
         elif len(book_ids):
-            self.build_single_book_menus(book_ids[0])
+            self.inspect_single_book(book_ids[0])
+
+    def inspect_single_book(self, book_id):
+        '''
+        Show placeholder entries for the selected book's kindle formats right away
+        and probe the formats on a background thread. The real menus replace the
+        placeholders once the probing is done. Reopening the menu for the same book,
+        formats and unpacking options shows what was already built, and the worker
+        thread only probes again if one of the format files has changed on disk.
+        '''
+        db = self.gui.library_view.model().db
+        all_formats = db.formats(book_id, index_is_id=True)
+        all_formats = all_formats.split(',') if all_formats else []
+        present = [format for format in all_formats if format in KINDLE_FORMATS]
+        key = (db.library_id, book_id, tuple(all_formats), tuple(sorted(cfg.unpack_options().items())))
+        if key == self.menu_key:
+            if self.menu_signatures is None or not present:
+                return
+        else:
+            self.menu_key = key
+            self.menu_signatures = None
+            if not present:
+                self.menu_signatures = ()
+                self.build_single_book_menus(book_id, [])
+                return
+            m = self.menu
+            m.clear()
+            for format in present:
+                tool_tip = 'Checking the {0} format.'.format(format)
+                placeholder = create_menu_item(self, m, _('Inspecting')+' {0}...'.format(format), None, _(tool_tip), None, None)
+                placeholder.setEnabled(False)
+            self.add_config_menu(m)
+        t = Thread(target=self.inspect_formats, args=(key, book_id, present, self.menu_signatures), name='KindleUnpackInspect')
+        t.daemon = True
+        t.start()
+
+    def format_signatures(self, book_id, formats):
+        '''
+        The probe_cache.file_signature of each of the book's format files (None if
+        it's missing). Only called on worker threads, since on a network library
+        each one is a round trip.
+        '''
+        from calibre_plugins.kindleunpack_plugin.probe_cache import file_signature
+        db = self.gui.library_view.model().db
+        signatures = []
+        for format in formats:
+            try:
+                signatures.append(file_signature(db.new_api.format_abspath(book_id, format)))
+            except (TypeError, EnvironmentError):
+                signatures.append(None)
+        return tuple(signatures)
+
+    def inspect_formats(self, key, book_id, formats, known_signatures=None):
+        '''
+        Runs on a worker thread. Gather and probe every kindle format of the book,
+        unless the menu already built from them (whose format files had
+        known_signatures) is still up to date.
+        '''
+        signatures = self.format_signatures(book_id, formats)
+        if signatures == known_signatures:
+            return
+        try:
+            book_list = self.gatherKindleFormats([book_id], formats)
+            for book in book_list:
+                for format_obj in book[2].values():
+                    format_obj.get_format_details()
+        except Exception:
+            traceback.print_exc()
+            book_list = []
+        self.inspection_done(key, book_id, book_list, signatures)
+
+    def inspected_single_book(self, key, book_id, book_list, signatures):
+        # The selection may have changed while the formats were being probed.
+        if key != self.menu_key:
+            return
+        self.menu_signatures = signatures
+        self.build_single_book_menus(book_id, book_list)
 
     def build_multiple_book_menus(self, book_ids):
         '''
@@ -72,30 +162,36 @@ class InterfacePlugin(InterfaceAction):
         create_menu_action_unique(self, m, _('Extract PDFs')+'...', 'mimetypes/pdf.png', _(tool_tip),
                                                  False, triggered=partial(self.multi_dispatcher, book_ids, u'AZW4'))
 
+        m.addSeparator()
+        tool_tip = 'Check which of the selected books KF8 to ePubs would convert, without converting anything.'
+        create_menu_action_unique(self, m, _('Analyze for KF8 to ePubs')+'...', 'search.png', _(tool_tip),
+                                                 False, triggered=partial(self.analyze_selection, book_ids, u'AZW3'))
+
+        tool_tip = 'Check which of the selected books Extract PDFs would work on, without extracting anything.'
+        create_menu_action_unique(self, m, _('Analyze for Extract PDFs')+'...', 'search.png', _(tool_tip),
+                                                 False, triggered=partial(self.analyze_selection, book_ids, u'AZW4'))
+
+        self.add_config_menu(m)
+
+    def add_config_menu(self, m):
         m.addSeparator()
         tool_tip = 'Configure the KindleUnpack plugin\'s settings.'
         create_menu_action_unique(self, m, _('Customize plugin')+'...', 'config.png', _(tool_tip),
                                   None, triggered=self.show_configuration)
         self.gui.keyboard.finalize()
 
-    def build_single_book_menus(self, book_id):
+    def build_single_book_menus(self, book_id, book_list):
         '''
         Build the menus that change on the fly based on selected ebook's
         formats and their various properties.
         '''
         m = self.menu
         m.clear()
-        kindle_formats = ['MOBI', 'AZW', 'AZW3', 'AZW4', 'PRC']
-        book_list = self.gatherKindleFormats([book_id], kindle_formats)
         if not book_list:
             tool_tip = 'No suitable format to unpack.'
             error_menu = create_menu_item(self, m, _(tool_tip)+'...', None, _(tool_tip), None, None)
             error_menu.setEnabled(False)
-            m.addSeparator()
-            tool_tip = 'Configure the KindleUnpack plugin\'s settings.'
-            create_menu_action_unique(self, m, _('Customize plugin')+'...', 'config.png', _(tool_tip),
-                                      None, triggered=self.show_configuration)
-            self.gui.keyboard.finalize()
+            self.add_config_menu(m)
             return
 
         format_dict = book_list[0][2]
@@ -148,7 +244,7 @@ class InterfacePlugin(InterfaceAction):
             if kindle_obj.isPrintReplica:
                 tool_tip = 'Extract the PDF from the Print Replica format and add it to the library.'
                 create_menu_action_unique(self, sm, _('Extract PDF')+'...', 'mimetypes/pdf.png', _(tool_tip), False,
-                                            triggered=partial(self.extract_element, kindle_obj, book_id, u'AZW4', False))
+                                            triggered=partial(self.extract_element, kindle_obj, book_id, u'AZW4'))
 
             # Offer to split kindlegen dual format output.
             if kindle_obj.isComboFile:
@@ -156,37 +252,49 @@ class InterfacePlugin(InterfaceAction):
                 create_menu_action_unique(self, sm, _('Split KF8/MOBI')+'...', 'edit-cut.png', _(tool_tip),
                                             False, triggered=partial(self.combo_split, kindle_obj))
 
+            # Save the kindlegen source archive embedded in the book.
+            if kindle_obj.hasSource:
+                tool_tip = 'Save the kindlegen source archive that the {0} was built from.'.format(format)
+                source_menu = create_menu_action_unique(self, sm, _('Extract kindlegen source')+'...', 'images/explode3.png',
+                                            _(tool_tip), False, triggered=partial(self.extract_source, kindle_obj))
+                if kindle_obj.isEncrypted:
+                    source_menu.setEnabled(False)
+
             # Extract ePub from the unpacked contents and add to current book's formats.
             convert_menu = None
             if kindle_obj.isKF8 or kindle_obj.isComboFile:
                 tool_tip = 'Convert standalone KF8 file to its original ePub.'
                 convert_menu = create_menu_action_unique(self, sm, _('KF8 to ePub')+'...', 'mimetypes/epub.png', _(tool_tip),
-                                            False, triggered=partial(self.extract_element, kindle_obj, book_id, u'AZW3', False))
+                                            False, triggered=partial(self.extract_element, kindle_obj, book_id, u'AZW3'))
             if kindle_obj.isEncrypted and convert_menu is not None:
                 convert_menu.setEnabled(False)
 
         # Add menu item to go to plugin configuration.
-        m.addSeparator()
-        tool_tip = 'Configure the KindleUnpack plugin\'s settings.'
-        create_menu_action_unique(self, m, _('Customize plugin')+'...', 'config.png', _(tool_tip),
-                                  None, triggered=self.show_configuration)
-        self.gui.keyboard.finalize()
+        self.add_config_menu(m)
         return
 
-    def update_db(self, bookfile, format, book_id):
+    def update_db(self, bookfile, format, book_id, notify=True):
         '''
         Update the calibre ebook entry with the extracted EPUB/PDF format.
-        (never overwriting a pre-existing one)
+        (never overwriting a pre-existing one) bookfile is either the path of
+        the extracted file or a stream already open on it.
         '''
         db = self.gui.library_view.model().db
-        stream = lopen(bookfile, 'rb')
-        return db.add_format(book_id, format, stream, index_is_id=True, replace=False, notify=True)
+        if hasattr(bookfile, 'read'):
+            return db.add_format(book_id, format, bookfile, index_is_id=True, replace=False, notify=notify)
+        with lopen(bookfile, 'rb') as stream:
+            return db.add_format(book_id, format, stream, index_is_id=True, replace=False, notify=notify)
 
     def show_configuration(self):
         '''
         Show plugin's configuration widget.
         '''
         self.interface_action_base_plugin.do_user_config(self.gui)
+        # The single book menu was built with the old settings.
+        self.menu_key = None
+
+    def library_changed(self, db):
+        self.menu_key = None
 
     def directoryChooser(self):
         '''
@@ -198,17 +306,19 @@ class InterfacePlugin(InterfaceAction):
             return choose_dir(self.gui, _(PLUGIN_NAME + 'dir_chooser'),
                 _('Select Directory To Unpack Kindle/Mobi Book To'))
 
-    def gatherKindleFormats(self, book_ids, target_formats, goal_format=None):
+    def gatherKindleFormats(self, book_ids, target_formats, goal_format=None, selection=None):
         '''
         Gathers all the kindle formats for the book(s) and uses the KindleFormats class
         in utlities.py to collect details about each one. Including an initialized
-        mobiProcessor object.
+        mobiProcessor object. selection is the SelectionFormats for book_ids, if the
+        caller already has one.
         '''
-        db = self.gui.library_view.model().db
+        if selection is None:
+            selection = SelectionFormats(self.gui.library_view.model().db, book_ids)
         books_info = []
         for book_id in book_ids:
-            title = db.get_metadata(book_id, index_is_id=True, get_user_categories=False).title
-            book = KindleFormats(book_id, db, target_formats, goal_format)
+            title = selection.title(book_id)
+            book = KindleFormats(book_id, selection, target_formats, goal_format)
             details = book.get_formats()
             if details:
                 books_info.append((book_id, title, details))
@@ -219,40 +329,77 @@ class InterfacePlugin(InterfaceAction):
         Prepares the necessaries to feed to ProgressDialog in dialogs.py
         '''
         db = self.gui.library_view.model().db
-        if target_format == 'AZW3':
-            attr = 'isKF8'
-            goal_format = 'EPUB'
-            status_msg_type='KF8 books'
-            action_type='Unpacking ePubs from'
-        elif target_format == 'AZW4':
-            attr = 'isPrintReplica'
-            goal_format = 'PDF'
-            status_msg_type='Print Replica books'
-            action_type='Extracting PDFs from'
-        books_info = self.gatherKindleFormats(book_ids, [target_format], goal_format)
+        goal_format = BATCH_ACTIONS[target_format][1]
+        selection = SelectionFormats(db, book_ids)
+        books_info = self.gatherKindleFormats(book_ids, [target_format], goal_format, selection)
         # If we have stuff ... send it on its way to the pretty ProgressDialog.
         if books_info:
-            d = ProgressDialog(self.gui, books_info, self.extract_element, db, target_format, attr,
-                                   status_msg_type=status_msg_type, action_type=action_type)
-            if d.wasCanceled():
-                return
-            successes, failures = d.get_results()
-            if successes:
-                ids_to_highlight = []
-                for i in successes:
-                    ids_to_highlight.append(i[0])
-                self.highlight_entries(ids_to_highlight)
-            title = PLUGIN_NAME + ' v' + PLUGIN_VERSION
-            plural = '' if len(successes) == 1 else 's'
-            msg = '<p>{0} {2} format{3} added to library. {1} not added. See log for details'.format(len(successes), len(failures), goal_format, plural)
-            log = build_log(failures, successes, target_format, goal_format, status_msg_type[:-1])
-            # print (log)
-            sd = ResultsSummaryDialog(self.gui, title, msg, log)
-            sd.exec_()
+            self.run_batch(books_info, selection, target_format)
         else:
             return info_dialog(None, _(PLUGIN_NAME + ' v' + PLUGIN_VERSION),
                 '<p>Nothing to do. Perhaps no books selected had {0} formats.'.format(target_format), show=True)
 
+    def run_batch(self, books_info, selection, target_format):
+        attr, goal_format, status_msg_type, action_type = BATCH_ACTIONS[target_format]
+        extractor = create_extractor(cfg.plugin_prefs['Worker_Processes'])
+        d = ProgressDialog(self.gui, books_info, extractor, self.add_elements, selection, target_format, attr,
+                               status_msg_type=status_msg_type, action_type=action_type)
+        successes, failures = d.get_results()
+        # The formats were added without notifying the GUI, so refresh
+        # everything that changed in one go (even if the batch was canceled).
+        self.refresh_books([i[0] for i in successes])
+        if d.wasCanceled():
+            return
+        if successes:
+            ids_to_highlight = []
+            for i in successes:
+                ids_to_highlight.append(i[0])
+            self.highlight_entries(ids_to_highlight)
+        title = PLUGIN_NAME + ' v' + PLUGIN_VERSION
+        plural = '' if len(successes) == 1 else 's'
+        msg = '<p>{0} {2} format{3} added to library. {1} not added. See log for details'.format(len(successes), len(failures), goal_format, plural)
+        log = build_log(failures, successes, target_format, goal_format, status_msg_type[:-1])
+        # print (log)
+        sd = ResultsSummaryDialog(self.gui, title, msg, log)
+        sd.exec_()
+
+    def analyze_selection(self, book_ids, target_format):
+        '''
+        Report what a multiple book action would do with the selection without
+        extracting anything, then offer to run it on just the eligible books.
+        '''
+        db = self.gui.library_view.model().db
+        attr, goal_format, status_msg_type = BATCH_ACTIONS[target_format][:3]
+        selection = SelectionFormats(db, book_ids)
+        books_info = self.gatherKindleFormats(book_ids, [target_format], goal_format, selection)
+        if books_info:
+            d = AnalysisDialog(self.gui, books_info, selection, target_format, attr, status_msg_type=status_msg_type)
+            if d.wasCanceled():
+                return
+            counts, eligible = d.get_results()
+        else:
+            counts, eligible = dict((outcome, 0) for outcome in OUTCOMES), []
+        # gatherKindleFormats leaves out the books without the format altogether.
+        counts['no_format'] += len(book_ids) - len(books_info)
+        labels = {'eligible': 'Would be converted to {0}'.format(goal_format),
+                  'exists': 'Already have a {0} format'.format(goal_format),
+                  'encrypted': 'Encrypted',
+                  'topaz': 'Topaz books',
+                  'not_eligible': 'Not {0}'.format(status_msg_type),
+                  'missing_file': 'No {0} file on disk'.format(target_format),
+                  'invalid': 'Not valid mobi/kindlebooks',
+                  'no_format': 'No {0} format'.format(target_format)}
+        rows = ''.join('<tr><td>{0}</td><td align="right">&nbsp;&nbsp;{1}</td></tr>'.format(labels[outcome], counts[outcome])
+                       for outcome in OUTCOMES if counts[outcome])
+        msg = '<p>{0} selected books:</p><table>{1}</table>'.format(len(book_ids), rows)
+        title = PLUGIN_NAME + ' v' + PLUGIN_VERSION
+        if not eligible:
+            return info_dialog(self.gui, title, msg + '<p>Nothing to do.', show=True)
+        plural = '' if len(eligible) == 1 else 's'
+        if question_dialog(self.gui, title, msg, yes_text='Start on {0} book{1}'.format(len(eligible), plural),
+                           no_text=_('Close')):
+            self.run_batch(eligible, selection, target_format)
+
     def highlight_entries(self, ids_to_highlight):
         # self.gui.library_view.model().books_added(len(ids_to_highlight))
         # self.gui.library_view.model().refresh()
@@ -273,49 +420,73 @@ class InterfacePlugin(InterfaceAction):
                 return showErrorDlg(str(e), self.gui, True)
             open_local_file(outdir)
 
-    def extract_element(self, kindle_obj, book_id, target, quiet=False):
+    def add_element(self, bookfile, format, book_id):
+        '''
+        Add an extracted EPUB/PDF to the book. Returns False if the book already has that format.
+        '''
+        if not self.update_db(bookfile, format, book_id):
+            return False
+        current_idx = self.gui.library_view.currentIndex()
+        if current_idx.isValid():
+            self.gui.library_view.model().current_changed(current_idx, current_idx)
+        return True
+
+    def add_elements(self, entries, format):
+        '''
+        Add a group of extracted EPUBs/PDFs, given as (book_id, bookfile) pairs, without
+        notifying the GUI about each one. Returns whether each was added: False if the
+        book already has that format, None if adding it failed. The caller refreshes the
+        books afterwards.
+        '''
+        added = []
+        for book_id, bookfile in entries:
+            try:
+                added.append(self.update_db(bookfile, format, book_id, notify=False))
+            except Exception:
+                traceback.print_exc()
+                added.append(None)
+        return added
+
+    def refresh_books(self, book_ids):
+        if not book_ids:
+            return
+        view = self.gui.library_view
+        view.model().refresh_ids(book_ids, current_row=view.currentIndex().row())
+        self.gui.tags_view.recount()
+
+    def extract_element(self, kindle_obj, book_id, target):
         '''
         ExtractPDFs/EPUBs from AZW4/AZW3 format(s).
         '''
-        outdir = PersistentTemporaryDirectory()
-        errmsg = ''
         if target == 'AZW3':
             errmsg = 'An'
             format = 'EPUB'
-            try:
-                bookfile = kindle_obj.unpackEPUB(outdir)
-            except Exception as e:
-                if quiet:
-                    return False, str(e)
-                return showErrorDlg(str(e), self.gui, True)
         elif target == 'AZW4':
             errmsg = 'A'
             format = 'PDF'
+        try:
+            with extracted_book(kindle_obj, target) as stream:
+                added = self.add_element(stream, format, book_id)
+        except Exception as e:
+            return showErrorDlg(str(e), self.gui, True)
+
+        if not added:
+            errmsg += ' {0} format already exists for this book in this library! No attempt to overwrite it will be made.'.format(format)
+            return showErrorDlg(errmsg, self.gui)
+        return info_dialog(None, _(PLUGIN_NAME + ' v' + PLUGIN_VERSION),
+        '<p>{0} successfully unpacked and added to ebook\'s formats in library.'.format(format), show=True)
+
+    def extract_source(self, kindle_obj):
+        '''
+        Save the kindlegen source archive to external folder.
+        '''
+        outdir = self.directoryChooser()
+        if outdir:
             try:
-                bookfile = kindle_obj.getPDFFile(outdir)
+                kindle_obj.getSourceArchive(outdir)
             except Exception as e:
-                if quiet:
-                    return False, str(e)
                 return showErrorDlg(str(e), self.gui, True)
-
-        if os.path.exists(bookfile):
-            if not self.update_db(bookfile, format, book_id):
-                errmsg += ' {0} format already exists for this book in this library! No attempt to overwrite it will be made.'.format(format)
-                if quiet:
-                    return False, None
-                return showErrorDlg(errmsg, self.gui)
-            current_idx = self.gui.library_view.currentIndex()
-            if current_idx.isValid():
-                self.gui.library_view.model().current_changed(current_idx, current_idx)
-            if quiet:
-                return True, None
-            return info_dialog(None, _(PLUGIN_NAME + ' v' + PLUGIN_VERSION),
-            '<p>{0} successfully unpacked and added to ebook\'s formats in library.'.format(format), show=True)
-
-        errmsg = 'Couldn\'t find {0} in unpacked kindlebook.'.format(format)
-        if quiet:
-            return False, errmsg
-        return showErrorDlg(errmsg, self.gui)
+            open_local_file(outdir)
 
     def combo_split(self, kindle_obj):
         '''
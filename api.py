@@ -0,0 +1,143 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+#####################################################################
+# GUI-free entry points to the plugin's unpacking code.
+#
+# Nothing imported here pulls in Qt, calibre.gui2 or the plugin's
+# preferences. Every option is passed in explicitly, so worker
+# processes, scripts and command line tools can use these just as
+# the GUI does.
+#####################################################################
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from calibre_plugins.kindleunpack_plugin.mobi_stuff import mobiProcessor
+
+KINDLE_FORMATS = ['MOBI', 'AZW', 'AZW3', 'AZW4', 'PRC']
+# Kindle format a multiple book action works on -> the format it produces.
+GOAL_FORMATS = {'AZW3': 'EPUB', 'AZW4': 'PDF'}
+# Operations understood by run_operation (and the command line).
+OPERATIONS = ('epub', 'pdf', 'split', 'unpack', 'source')
+# Default number of text records from which a book's text is decompressed
+# by a pool of worker processes rather than record by record (see
+# mobi_text). Starting the workers costs about a second, so only really
+# large books gain from it.
+PARALLEL_RECORDS = 4000
+# Size up to which an ePub rebuilt for extracted_book is kept in memory
+# before it spills over into a temporary file.
+EPUB_SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def probe(path, probe_cache=None, epub_version='2', use_hd=False, prefer_source=False, parallel_records=0):
+    '''
+    Classify a kindlebook and return the mobiProcessor for it. Raises if
+    path isn't a MOBI/KF8 book.
+
+    :param probe_cache: Optional ProbeCache (see probe_cache.py) to consult first.
+    :param epub_version: '2', '3' or 'A' (auto-detect) for any ePub produced later.
+    :param use_hd: Prefer HD images when they are present.
+    :param prefer_source: Produce ePubs from the EPUB in the book's kindlegen
+        source archive when there is one, rather than rebuilding them.
+    :param parallel_records: Decompress the text of books with at least this
+        many text records in a pool of worker processes. 0 never does.
+    '''
+    return mobiProcessor(path, probe_cache, epub_version, use_hd, prefer_source, parallel_records)
+
+def unpack(path, outdir, epub_version='2', use_hd=False, output='all', parallel_records=0):
+    '''
+    Unpack the book's source components into outdir.
+
+    :param output: One of mobi_stuff.OUTPUTS. 'epub' only rebuilds the KF8 half of a
+        combo book and 'mobi7' only the MOBI7 half.
+    :param parallel_records: See probe.
+    '''
+    probe(path, epub_version=epub_version, use_hd=use_hd, parallel_records=parallel_records).unpackMOBI(outdir, output)
+
+def extract_epub(path, outdir, epub_version='2', use_hd=False, prefer_source=False, parallel_records=0):
+    '''
+    Rebuild the ePub from a KF8 or combo book and return its path.
+    '''
+    return extract_book(probe(path, epub_version=epub_version, use_hd=use_hd, prefer_source=prefer_source,
+                              parallel_records=parallel_records), 'AZW3', outdir)
+
+def extract_pdf(path, outdir):
+    '''
+    Pull the PDF out of a Print Replica book and return its path.
+    '''
+    return extract_book(probe(path), 'AZW4', outdir)
+
+def split_combo(path, outdir):
+    '''
+    Split a combo KF8/MOBI book into its two halves. Returns their paths.
+    '''
+    return probe(path).writeSplitCombo(outdir)
+
+def extract_source(path, outdir):
+    '''
+    Save the kindlegen source archive (SRCS) of a book and return its path.
+    '''
+    kindle_obj = probe(path)
+    if not kindle_obj.hasSource:
+        raise Exception('No kindlegen source archive in {0}.'.format(path))
+    return kindle_obj.getSourceArchive(outdir)
+
+def extract_book(kindle_obj, target, outdir):
+    '''
+    Unpack the EPUB/PDF from an already probed AZW3/AZW4 format into outdir and return its path.
+    '''
+    if target == 'AZW3':
+        bookfile = kindle_obj.unpackEPUB(outdir)
+    elif target == 'AZW4':
+        bookfile = kindle_obj.getPDFFile(outdir)
+    if not os.path.exists(bookfile):
+        raise Exception('Couldn\'t find {0} in unpacked kindlebook.'.format(GOAL_FORMATS[target]))
+    return bookfile
+
+@contextmanager
+def extracted_book(kindle_obj, target):
+    '''
+    Yield a stream open on the EPUB/PDF unpacked from an already probed
+    AZW3/AZW4 format. An ePub rebuilt from the KF8 half is written straight
+    into the stream (see mobiProcessor.writeEPUB). Anything else is staged
+    in a folder that is removed as soon as the caller is done with the stream.
+    '''
+    if target == 'AZW3' and not (kindle_obj.preferSource and kindle_obj.hasSource):
+        with tempfile.SpooledTemporaryFile(EPUB_SPOOL_SIZE) as stream:
+            kindle_obj.writeEPUB(stream)
+            stream.seek(0)
+            yield stream
+        return
+    outdir = tempfile.mkdtemp(prefix='kindleunpack_')
+    try:
+        with open(extract_book(kindle_obj, target, outdir), 'rb') as stream:
+            yield stream
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+def run_operation(kindle_obj, operation, outdir, output='all'):
+    '''
+    Run one of OPERATIONS on an already probed book, writing into outdir.
+    output (see mobi_stuff.OUTPUTS) only applies to a full unpack.
+    Returns the path of the EPUB/PDF/source archive, the paths of the two
+    split halves, or outdir itself for a full unpack.
+    '''
+    if operation == 'epub':
+        return extract_book(kindle_obj, 'AZW3', outdir)
+    elif operation == 'pdf':
+        return extract_book(kindle_obj, 'AZW4', outdir)
+    elif operation == 'split':
+        return list(kindle_obj.writeSplitCombo(outdir))
+    elif operation == 'unpack':
+        kindle_obj.unpackMOBI(outdir, output)
+        return outdir
+    elif operation == 'source':
+        return kindle_obj.getSourceArchive(outdir)
+    raise ValueError('Unknown operation: {0}'.format(operation))
@@ -0,0 +1,209 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import json
+import argparse
+from threading import Event
+
+from calibre_plugins.kindleunpack_plugin.__init__ import PLUGIN_NAME, PLUGIN_VERSION
+from calibre_plugins.kindleunpack_plugin.api import KINDLE_FORMATS, OPERATIONS, PARALLEL_RECORDS, probe
+from calibre_plugins.kindleunpack_plugin.jobs import create_extractor
+from calibre_plugins.kindleunpack_plugin.mobi_stuff import OUTPUTS
+
+USAGE = 'calibre-debug -r "{0}" -- --library PATH --operation {{{1}}} [options]'.format(PLUGIN_NAME, ','.join(OPERATIONS))
+
+# Kindle format each operation works on when --format isn't given. None means
+# the first kindle format the book has.
+DEFAULT_FORMATS = {'epub': 'AZW3', 'pdf': 'AZW4', 'split': None, 'unpack': None, 'source': None}
+# Formats the epub/pdf operations add to the library.
+GOAL_FORMATS = {'epub': 'EPUB', 'pdf': 'PDF'}
+
+
+def option_parser():
+    parser = argparse.ArgumentParser(prog='KindleUnpack', usage=USAGE,
+        description='Run KindleUnpack over the books of a calibre library without the GUI. '
+        'epub and pdf add the extracted format to each book (never overwriting an existing one). '
+        'split, unpack and source write into a folder per book id under --outdir.')
+    parser.add_argument('--library', required=True, help='Path of the calibre library folder.')
+    parser.add_argument('--operation', required=True, choices=OPERATIONS, help='What to do with each book.')
+    parser.add_argument('--ids', default=None,
+                        help='Book ids to process, as a comma separated list of ids and ranges (e.g. 1-500,731).')
+    parser.add_argument('--search', default=None, help='calibre search expression selecting the books to process.')
+    parser.add_argument('--format', default=None, type=lambda x: x.upper(), choices=KINDLE_FORMATS,
+                        help='Kindle format to work on. Defaults to AZW3 for epub, AZW4 for pdf and '
+                        'the first kindle format a book has otherwise.')
+    parser.add_argument('--outdir', default=None, help='Output folder for split, unpack and source.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes (default: 1).')
+    parser.add_argument('--epub-version', default='2', choices=('2', '3', 'A'),
+                        help='ePub version to create, A to auto-detect (default: 2).')
+    parser.add_argument('--output', default='all', choices=OUTPUTS,
+                        help='What unpack rebuilds from a combo KF8/MOBI book: both halves (all), '
+                        'only the KF8 ePub (epub) or only the MOBI7 book (mobi7). Default: all.')
+    parser.add_argument('--hd', action='store_true', help='Use HD images if present.')
+    parser.add_argument('--prefer-source', action='store_true',
+                        help='For epub, use the EPUB in a book\'s kindlegen source archive when it has one.')
+    parser.add_argument('--parallel-records', type=int, default=PARALLEL_RECORDS,
+                        help='With --jobs 1, decompress the text of books with at least this many text records '
+                        'on all cores. 0 never does (default: {0}).'.format(PARALLEL_RECORDS))
+    parser.add_argument('--summary', default=None,
+                        help='Write a JSON summary of the run to this file (- for standard output).')
+    return parser
+
+def parse_ids(spec):
+    ids = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ids.update(range(int(first), int(last) + 1))
+        else:
+            ids.add(int(part))
+    return ids
+
+def select_books(db, opts):
+    book_ids = set(db.all_book_ids())
+    if opts.ids:
+        book_ids &= parse_ids(opts.ids)
+    if opts.search:
+        book_ids &= set(db.search(opts.search))
+    return sorted(book_ids)
+
+
+class Run:
+    '''
+    Check each selected book, hand the eligible ones to the extractor and
+    record what happened to every one of them.
+    '''
+    def __init__(self, db, opts):
+        self.db, self.opts = db, opts
+        self.results = []
+        self.total = 0
+        self.options = {'epub_version': opts.epub_version, 'use_hd': opts.hd, 'prefer_source': opts.prefer_source,
+                        'parallel_records': opts.parallel_records}
+        self.extractor = None
+
+    def record(self, book_id, title, format, status, message=None, output=None):
+        result = {'book_id': book_id, 'title': title, 'format': format, 'status': status}
+        if message is not None:
+            result['message'] = message
+        if output is not None:
+            result['output'] = output
+        self.results.append(result)
+        print('[{0}/{1}] {2} ({3}): {4}{5}'.format(len(self.results), self.total, title, book_id, status,
+                                                  ' - ' + message if message else ''))
+        sys.stdout.flush()
+
+    def check_book(self, book_id, title, formats):
+        '''
+        Returns the (format, kindle_obj) to process, or records why the book is skipped.
+        '''
+        opts = self.opts
+        format = opts.format or DEFAULT_FORMATS[opts.operation]
+        if format is None:
+            format = next((f for f in KINDLE_FORMATS if f in formats), None)
+        if format is None or format not in formats:
+            return self.record(book_id, title, format, 'no_format')
+        if opts.operation in GOAL_FORMATS and GOAL_FORMATS[opts.operation] in formats:
+            return self.record(book_id, title, format, 'exists')
+        path = self.db.format_abspath(book_id, format)
+        if path is None:
+            return self.record(book_id, title, format, 'missing_file')
+        try:
+            kindle_obj = probe(path, **self.options)
+        except Exception as e:
+            return self.record(book_id, title, format, 'invalid', str(e))
+        if kindle_obj.isEncrypted:
+            return self.record(book_id, title, format, 'encrypted')
+        eligible = {'epub': kindle_obj.isKF8 or kindle_obj.isComboFile, 'pdf': kindle_obj.isPrintReplica,
+                    'split': kindle_obj.isComboFile, 'source': kindle_obj.hasSource,
+                    'unpack': {'all': True, 'epub': kindle_obj.isKF8 or kindle_obj.isComboFile,
+                               'mobi7': not kindle_obj.isKF8}[opts.output]}[opts.operation]
+        if not eligible:
+            return self.record(book_id, title, format, 'not_eligible')
+        return format, kindle_obj
+
+    def finish_book(self, key, result, errmsg):
+        book_id, title, format = key
+        if result is None:
+            self.record(book_id, title, format, 'failed', errmsg)
+        elif self.opts.operation in GOAL_FORMATS:
+            goal = GOAL_FORMATS[self.opts.operation]
+            if self.db.add_format(book_id, goal, result, replace=False):
+                self.record(book_id, title, format, 'added')
+            else:
+                self.record(book_id, title, format, 'exists')
+        else:
+            self.record(book_id, title, format, 'written', output=result)
+        self.extractor.discard(key)
+
+    def process(self, book_ids):
+        self.total = len(book_ids)
+        self.extractor = extractor = create_extractor(self.opts.jobs)
+        abort = Event()
+        try:
+            # One batched read of titles and format lists for the whole run.
+            titles = self.db.all_field_for('title', book_ids)
+            all_formats = self.db.all_field_for('formats', book_ids)
+            for book_id in book_ids:
+                title = titles[book_id]
+                checked = self.check_book(book_id, title, all_formats[book_id] or ())
+                if checked is None:
+                    continue
+                format, kindle_obj = checked
+                # epub/pdf are staged in the extractor's scratch space and
+                # only kept until they have been added to the library.
+                outdir = None
+                if self.opts.operation not in GOAL_FORMATS:
+                    outdir = os.path.join(self.opts.outdir, str(book_id))
+                    if not os.path.exists(outdir):
+                        os.makedirs(outdir)
+                extractor.submit((book_id, title, format), kindle_obj, self.opts.operation, outdir, self.opts.output)
+                for key, result, errmsg in extractor.finished():
+                    self.finish_book(key, result, errmsg)
+            for key, result, errmsg in extractor.drain(abort):
+                self.finish_book(key, result, errmsg)
+        finally:
+            abort.set()
+            extractor.close()
+            extractor.cleanup()
+
+    def summary(self):
+        counts = {}
+        for result in self.results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return {'plugin_version': PLUGIN_VERSION, 'library': self.opts.library, 'operation': self.opts.operation,
+                'total': self.total, 'counts': counts, 'books': self.results}
+
+
+def main(args):
+    '''
+    args[0] is the plugin name, as passed along by calibre-debug -r.
+    '''
+    parser = option_parser()
+    opts = parser.parse_args(args[1:])
+    if opts.operation not in GOAL_FORMATS and not opts.outdir:
+        parser.error('--outdir is required for the {0} operation'.format(opts.operation))
+    if opts.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    from calibre.library import db as library_db
+    db = library_db(os.path.abspath(opts.library)).new_api
+    run = Run(db, opts)
+    run.process(select_books(db, opts))
+
+    summary = run.summary()
+    print('Done: ' + ', '.join('{0} {1}'.format(v, k) for k, v in sorted(summary['counts'].items())))
+    if opts.summary == '-':
+        print(json.dumps(summary, indent=2))
+    elif opts.summary:
+        with open(opts.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 1 if 'failed' in summary['counts'] else 0
@@ -19,23 +19,25 @@ else:
 
 try:
     from qt.core import (QWidget, QLabel, QLineEdit, QPushButton, QCheckBox,
-                        QGroupBox, QVBoxLayout, QComboBox)
+                        QGroupBox, QVBoxLayout, QHBoxLayout, QComboBox, QSpinBox)
 except ImportError:
     try:
         from PyQt5.Qt import (QWidget, QLabel, QLineEdit, QPushButton, QCheckBox,
-                                QGroupBox, QVBoxLayout, QComboBox)
+                                QGroupBox, QVBoxLayout, QHBoxLayout, QComboBox, QSpinBox)
     except ImportError:
         from PyQt4.Qt import (QWidget, QLabel, QLineEdit, QPushButton, QCheckBox,
-                                QGroupBox, QVBoxLayout, QComboBox)
+                                QGroupBox, QVBoxLayout, QHBoxLayout, QComboBox, QSpinBox)
 
 from calibre.utils.config import JSONConfig
 try:
     from calibre.utils.filenames import expanduser
 except ImportError:
     pass
+from calibre import detect_ncpus
 from calibre.gui2 import choose_dir, error_dialog
 
 from calibre_plugins.kindleunpack_plugin.__init__ import PLUGIN_NAME, PLUGIN_VERSION
+from calibre_plugins.kindleunpack_plugin.api import PARALLEL_RECORDS
 
 PLUGIN_ICONS = ['images/explode3.png', 'images/acrobat.png']
 
@@ -51,6 +53,17 @@ except:
 plugin_prefs.defaults['Always_Use_Unpack_Folder'] = False
 plugin_prefs.defaults['Use_HD_Images'] = False
 plugin_prefs.defaults['Epub_Version'] = '2'
+plugin_prefs.defaults['Worker_Processes'] = 1
+plugin_prefs.defaults['Prefer_Embedded_Source'] = False
+plugin_prefs.defaults['Parallel_Text_Records'] = PARALLEL_RECORDS
+
+def unpack_options():
+    '''
+    The unpacking preferences as keyword arguments for the functions in api.py.
+    '''
+    return {'epub_version': plugin_prefs['Epub_Version'], 'use_hd': plugin_prefs['Use_HD_Images'],
+            'prefer_source': plugin_prefs['Prefer_Embedded_Source'],
+            'parallel_records': plugin_prefs['Parallel_Text_Records']}
 
 class ConfigWidget(QWidget):
 
@@ -98,6 +111,13 @@ class ConfigWidget(QWidget):
         # Load the checkbox with the current preference setting
         self.use_hd_images.setChecked(plugin_prefs['Use_HD_Images'])
 
+        self.prefer_source = QCheckBox(_('Use the original EPUB from kindlegen source archives'), self)
+        self.prefer_source.setToolTip(_('<p>When checked... KF8 to ePub uses the EPUB stored in a kindlebook\'s '+
+                                                                                'kindlegen source archive, when it has one, instead of rebuilding it.'))
+        misc_group_box_layout.addWidget(self.prefer_source)
+        # Load the checkbox with the current preference setting
+        self.prefer_source.setChecked(plugin_prefs['Prefer_Embedded_Source'])
+
         combo_label = QLabel('Select epub version output:', self)
         misc_group_box_layout.addWidget(combo_label)
         self.epub_version_combobox = QComboBox()
@@ -109,11 +129,40 @@ class ConfigWidget(QWidget):
         else:
             self.epub_version_combobox.setCurrentIndex(int(plugin_prefs['Epub_Version'])-1)
 
+        workers_layout = QHBoxLayout()
+        misc_group_box_layout.addLayout(workers_layout)
+        workers_label = QLabel(_('Worker processes for multiple book actions:'), self)
+        workers_layout.addWidget(workers_label)
+        self.workers_spinbox = QSpinBox(self)
+        self.workers_spinbox.setToolTip(_('<p>Number of books to unpack at the same time when converting/extracting '+
+                                                                                'multiple books. 1 unpacks them one at a time inside calibre.'))
+        self.workers_spinbox.setRange(1, max(detect_ncpus(), plugin_prefs['Worker_Processes']))
+        workers_layout.addWidget(self.workers_spinbox)
+        # Load the spinbox with the current preference setting
+        self.workers_spinbox.setValue(plugin_prefs['Worker_Processes'])
+
+        parallel_layout = QHBoxLayout()
+        misc_group_box_layout.addLayout(parallel_layout)
+        parallel_label = QLabel(_('Decompress text in parallel from (text records):'), self)
+        parallel_layout.addWidget(parallel_label)
+        self.parallel_spinbox = QSpinBox(self)
+        self.parallel_spinbox.setToolTip(_('<p>Books with at least this many text records have their text '+
+                                                                                'decompressed by all cores at once. Only applies when books are unpacked '+
+                                                                                'one at a time. 0 never does.'))
+        self.parallel_spinbox.setRange(0, 1000000)
+        self.parallel_spinbox.setSingleStep(1000)
+        parallel_layout.addWidget(self.parallel_spinbox)
+        # Load the spinbox with the current preference setting
+        self.parallel_spinbox.setValue(plugin_prefs['Parallel_Text_Records'])
+
     def save_settings(self):
         # Save current dialog sttings back to JSON config file
             plugin_prefs['Unpack_Folder'] = text_type(self.directory_txtBox.displayText())
             plugin_prefs['Always_Use_Unpack_Folder'] = self.default_folder_check.isChecked()
             plugin_prefs['Use_HD_Images'] = self.use_hd_images.isChecked()
+            plugin_prefs['Prefer_Embedded_Source'] = self.prefer_source.isChecked()
+            plugin_prefs['Worker_Processes'] = self.workers_spinbox.value()
+            plugin_prefs['Parallel_Text_Records'] = self.parallel_spinbox.value()
             if text_type(self.epub_version_combobox.currentText()) == 'Auto-detect':
                 plugin_prefs['Epub_Version'] = 'A'
             else:
@@ -5,29 +5,45 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__   = 'GPL v3'
 __docformat__ = 'restructuredtext en'
 
+import traceback
+from threading import Thread, Event
+
 try:
-    from qt.core import (Qt, QProgressDialog, QTimer, QSize, QDialog, QIcon,
+    from qt.core import (Qt, QProgressDialog, QSize, QDialog, QIcon,
                     QDialogButtonBox, QApplication, QTextBrowser, QVBoxLayout)
 except ImportError:
     try:
-        from PyQt5.Qt import (Qt, QProgressDialog, QTimer, QSize, QDialog, QIcon,
+        from PyQt5.Qt import (Qt, QProgressDialog, QSize, QDialog, QIcon,
                         QDialogButtonBox, QApplication, QTextBrowser, QVBoxLayout)
     except ImportError:
-        from PyQt4.Qt import (Qt, QProgressDialog, QTimer, QSize, QDialog, QIcon,
+        from PyQt4.Qt import (Qt, QProgressDialog, QSize, QDialog, QIcon,
                         QDialogButtonBox, QApplication, QTextBrowser, QVBoxLayout)
 
+from calibre.gui2 import Dispatcher
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre_plugins.kindleunpack_plugin.__init__ import (PLUGIN_NAME, PLUGIN_VERSION)
+from calibre_plugins.kindleunpack_plugin.utilities import probe_books, precheck_book, classify_book, OUTCOMES
 
 class ProgressDialog(QProgressDialog):
     '''
     Used to process Multiple selections of AZW3/AZW4 into EPUBs/PDFs.
+
+    The books are checked on a worker thread and handed to extractor, which
+    unpacks them either right there or on a pool of worker processes (see
+    jobs.py). Only the progress updates and the finished files come back to
+    the GUI thread. There commit_fn adds them to the library in groups of
+    COMMIT_BATCH, given a list of (book_id, bookfile) pairs and the format,
+    and returns whether each one was added. selection is the
+    SelectionFormats (see utilities.py) the books were gathered with.
     '''
-    def __init__(self, gui, books, callback_fn, db, target_format, attr, status_msg_type='books', action_type='Checking'):
+    COMMIT_BATCH = 25
+
+    def __init__(self, gui, books, extractor, commit_fn, selection, target_format, attr, status_msg_type='books', action_type='Checking'):
         self.total_count = len(books)
         QProgressDialog.__init__(self, '', 'Cancel', 0, self.total_count, gui)
         self.setMinimumWidth(500)
-        self.books, self.callback_fn, self.db, self.target_format, self.attr = books, callback_fn, db, target_format, attr
+        self.books, self.extractor, self.commit_fn, self.selection = books, extractor, commit_fn, selection
+        self.target_format, self.attr = target_format, attr
         self.action_type, self.status_msg_type = action_type, status_msg_type
         if attr == 'isKF8':
             self.kindle_type = 'KF8'
@@ -39,61 +55,142 @@ class ProgressDialog(QProgressDialog):
         zero = 0
         self.setWindowTitle('{0} {1} {2} ({3} issues)...'.format(self.action_type, self.total_count, self.status_msg_type, zero))
         self.i, self.successes, self.failures = 0, [], []
-        QTimer.singleShot(0, self.do_multiple_book_action)
+        # Finished (book_id, dtitle, bookfile) waiting to be added to the library.
+        self.pending = []
+        # The dialog stays up until do_close has committed the last group
+        # of books: neither reaching the maximum nor Cancel may hide it,
+        # or exec_() would return with those books still unaccounted for.
+        self.setAutoClose(False)
+        self.setAutoReset(False)
+        self.canceled.disconnect(self.cancel)
+        self.abort = Event()
+        self.canceled.connect(self.abort.set)
+        self.canceled.connect(self.show_canceling)
+        self.book_started = Dispatcher(self.show_book)
+        self.book_finished = Dispatcher(self.book_processed)
+        self.batch_finished = Dispatcher(self.do_close)
+        self.worker = Thread(target=self.do_multiple_book_action, name='KindleUnpackBatch')
+        self.worker.daemon = True
+        self.worker.start()
         self.exec_()
 
     def do_multiple_book_action(self):
-        if self.wasCanceled():
-            return self.do_close()
-        if self.i >= self.total_count:
-            return self.do_close()
-        book_info = self.books[self.i]
-        self.i += 1
+        '''
+        Runs on the worker thread.
+        '''
+        try:
+            # The books are probed a little ahead of being checked, several at a
+            # time. Those the format lists already rule out are never opened.
+            def skip(book_info):
+                return precheck_book(book_info, self.target_format, self.selection) is not None
+            for i, book_info in enumerate(probe_books(self.books, skip=skip)):
+                if self.abort.is_set():
+                    break
+                # Let go of each entry as it is handled so a large selection
+                # isn't held in memory until the dialog closes.
+                self.books[i] = None
+                book_id, dtitle = book_info[0], book_info[1]
+                self.book_started(dtitle)
+                try:
+                    failure, kindle_obj = self.check_book(book_info)
+                except Exception:
+                    traceback.print_exc()
+                    failure = (4, dtitle, 'Unknown error processing {0}\'s {1} format'.format(dtitle, self.target_format))
+                if failure is not None:
+                    self.book_finished(book_id, dtitle, failure, None)
+                else:
+                    self.extractor.submit((book_id, dtitle), kindle_obj, self.goal.lower())
+                self.report(self.extractor.finished())
+            self.report(self.extractor.drain(self.abort))
+        finally:
+            self.extractor.close()
+            self.batch_finished()
 
-        book_id, dtitle, format_dict = book_info[0], book_info[1], book_info[2]
+    def report(self, results):
+        for (book_id, dtitle), bookfile, errmsg in results:
+            failure = None
+            if bookfile is None:
+                failure = (4, dtitle, 'Unknown error processing {0}\'s {1} format'.format(dtitle, self.target_format))
+            self.book_finished(book_id, dtitle, failure, bookfile)
 
-        all_formats = self.db.formats(book_id, index_is_id=True, verify_formats=True)
-        if all_formats is not None:
-            all_formats = all_formats.split(',')
-        else:
-            all_formats = []
+    def check_book(self, book_info):
+        '''
+        Returns a (failure, kindle_obj) tuple. Exactly one of them is None.
+        '''
+        dtitle = book_info[1]
+        outcome, kindle_obj = classify_book(book_info, self.target_format, self.attr, self.selection)
+        if outcome == 'eligible':
+            return None, kindle_obj
+        if outcome == 'no_format':
+            return (1, dtitle, '{0} has no {1} format to work with.'.format(dtitle, self.target_format)), None
+        if outcome == 'encrypted':
+            return (2, dtitle, '{0} is encrypted.'.format(dtitle)), None
+        if outcome == 'not_eligible':
+            return (3, dtitle, '{0}\'s {1} format is not a {2} book.'.format(dtitle, self.target_format, self.kindle_type)), None
+        if outcome == 'exists':
+            return (5, dtitle, '{0} already has a {1} format. Won\'t overwrite.'.format(dtitle, self.goal)), None
+        return (2, dtitle, '{0}\'s {1} format might not be a valid mobi/kindlebook.'.format(dtitle, self.target_format)), None
 
+    def show_book(self, dtitle):
+        if self.abort.is_set():
+            return
         self.setWindowTitle('{0} {1} {2}  ({3} issues)...'.format(self.action_type, self.total_count,
                                                                 self.status_msg_type, len(self.failures)))
         self.setLabelText('{0}: {1}'.format(self.action_type, dtitle))
 
-        if self.target_format in format_dict.keys():
-            format = format_dict[self.target_format].get_format_details()
+    def show_canceling(self):
+        self.setLabelText('Canceling...')
 
-            if format['errors'] is not None:
-                self.failures.append((2, dtitle, '{0}\'s {1} format might not be a valid mobi/kindlebook.'.format(dtitle, format)))
-            else:
-                kindle_obj = format['kindle_obj']
-
-                if not kindle_obj.isEncrypted:
-                    if getattr(kindle_obj, self.attr):
-                        if format['goal_format'] not in all_formats:
-                            success, error = self.callback_fn(kindle_obj, book_id, self.target_format, True)
-                            if success:
-                                self.successes.append((book_id, dtitle))
-                            elif error is None:
-                                self.failures.append((5, dtitle, '{0} already has a {1} format. Won\'t overwrite.'.format(dtitle, format['goal_format'])))
-                            else:
-                                self.failures.append((4, dtitle, 'Unknown error processing {0}\'s {1} format'.format(dtitle, self.target_format)))
-                        else:
-                            self.failures.append((5, dtitle, '{0} already has a {1} format. Won\'t overwrite.'.format(dtitle, format['goal_format'])))
-                    else:
-                        self.failures.append((3, dtitle, '{0}\'s {1} format is not a {2} book.'.format(dtitle, self.target_format, self.kindle_type)))
-                else:
-                    self.failures.append((2, dtitle, '{0} is encrypted.'.format(dtitle)))
-        else:
-            self.failures.append((1, dtitle, '{0} has no {1} format to work with.'.format(dtitle, self.target_format)))
+    def wasCanceled(self):
+        return self.abort.is_set()
+
+    def reject(self):
+        # Escape or closing the window cancels, like the Cancel button.
+        # do_close hides the dialog once the worker thread has stopped.
+        self.canceled.emit()
+
+    def closeEvent(self, e):
+        e.ignore()
+        self.canceled.emit()
 
+    def book_processed(self, book_id, dtitle, failure, bookfile):
+        # Anything that finishes after Cancel was pressed is dropped.
+        if self.abort.is_set():
+            self.extractor.discard((book_id, dtitle))
+            return
+        if bookfile is not None:
+            self.pending.append((book_id, dtitle, bookfile))
+            if len(self.pending) >= self.COMMIT_BATCH:
+                self.commit_pending()
+        if failure is not None:
+            self.failures.append(failure)
+        self.i += 1
         self.setValue(self.i)
 
-        QTimer.singleShot(0, self.do_multiple_book_action)
+    def commit_pending(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        try:
+            added = self.commit_fn([(book_id, bookfile) for book_id, dtitle, bookfile in pending], self.goal)
+        except Exception:
+            traceback.print_exc()
+            added = [None] * len(pending)
+        finally:
+            for book_id, dtitle, bookfile in pending:
+                self.extractor.discard((book_id, dtitle))
+        for (book_id, dtitle, bookfile), was_added in zip(pending, added):
+            if was_added:
+                self.successes.append((book_id, dtitle))
+            elif was_added is None:
+                self.failures.append((4, dtitle, 'Unknown error adding {0}\'s {1} format'.format(dtitle, self.goal)))
+            else:
+                self.failures.append((5, dtitle, '{0} already has a {1} format. Won\'t overwrite.'.format(dtitle, self.goal)))
 
     def do_close(self):
+        # Books that finished before a Cancel still get added.
+        self.commit_pending()
+        self.extractor.cleanup()
         self.hide()
         self.gui = None
 
@@ -101,6 +198,68 @@ class ProgressDialog(QProgressDialog):
         return self.successes, self.failures
 
 
+class AnalysisDialog(QProgressDialog):
+    '''
+    Dry run of a multiple book action. Classifies each of the books (see
+    utilities.classify_book) from the library's format lists and the
+    header-only probe, without extracting anything, and keeps the counts per
+    outcome along with the books that are eligible.
+    '''
+    def __init__(self, gui, books, selection, target_format, attr, status_msg_type='books'):
+        self.total_count = len(books)
+        QProgressDialog.__init__(self, '', 'Cancel', 0, self.total_count, gui)
+        self.setMinimumWidth(500)
+        self.books, self.selection = books, selection
+        self.target_format, self.attr = target_format, attr
+        self.setWindowTitle('Analyzing {0} {1}...'.format(self.total_count, status_msg_type))
+        self.i = 0
+        self.counts = dict((outcome, 0) for outcome in OUTCOMES)
+        self.eligible = []
+        self.abort = Event()
+        self.canceled.connect(self.abort.set)
+        self.book_classified = Dispatcher(self.count_book)
+        self.analysis_finished = Dispatcher(self.do_close)
+        self.worker = Thread(target=self.do_analysis, name='KindleUnpackAnalysis')
+        self.worker.daemon = True
+        self.worker.start()
+        self.exec_()
+
+    def do_analysis(self):
+        '''
+        Runs on the worker thread.
+        '''
+        try:
+            def skip(book_info):
+                return precheck_book(book_info, self.target_format, self.selection) is not None
+            for book_info in probe_books(self.books, skip=skip):
+                if self.abort.is_set():
+                    break
+                try:
+                    outcome = classify_book(book_info, self.target_format, self.attr, self.selection)[0]
+                except Exception:
+                    traceback.print_exc()
+                    outcome = 'invalid'
+                self.book_classified(book_info, outcome)
+        finally:
+            self.analysis_finished()
+
+    def count_book(self, book_info, outcome):
+        if self.abort.is_set():
+            return
+        self.counts[outcome] += 1
+        if outcome == 'eligible':
+            self.eligible.append(book_info)
+        self.i += 1
+        self.setLabelText('Checked: {0}'.format(book_info[1]))
+        self.setValue(self.i)
+
+    def do_close(self):
+        self.hide()
+
+    def get_results(self):
+        return self.counts, self.eligible
+
+
 class ViewLog(QDialog):
 
     def __init__(self, title, html, parent=None):
@@ -0,0 +1,188 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+import shutil
+import tempfile
+import traceback
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from calibre.ptempfile import PersistentTemporaryDirectory
+
+from calibre_plugins.kindleunpack_plugin.api import probe, run_operation
+
+WORKER_MODULE = 'calibre_plugins.kindleunpack_plugin.jobs'
+
+
+def do_extract_worker(path, operation, outdir, epub_version, use_hd, prefer_source=False, output='all'):
+    '''
+    Entry point run inside a calibre worker process by the 'arbitrary' job.
+    Returns a (result, errmsg) tuple; exactly one of them is None.
+    '''
+    try:
+        kindle_obj = probe(path, epub_version=epub_version, use_hd=use_hd, prefer_source=prefer_source)
+        return run_operation(kindle_obj, operation, outdir, output), None
+    except Exception as e:
+        traceback.print_exc()
+        return None, str(e)
+
+def finished_jobs(server, pending, block=False):
+    '''
+    Yield each job of pending (ParallelJobs added to server) that has
+    finished since the last call. If block is true, waits up to half a
+    second for a job to change first.
+    '''
+    try:
+        while True:
+            job = server.changed_jobs_queue.get(block, 0.5)
+            block = False
+            # A job also 'changes' when it sends a notification. Ignore those.
+            job.update()
+            if job.is_finished and job in pending:
+                yield job
+    except Empty:
+        pass
+
+def create_extractor(pool_size):
+    if pool_size > 1:
+        return PoolExtractor(pool_size)
+    return SerialExtractor()
+
+
+class ScratchSpace:
+    '''
+    Staging folders for books submitted without an outdir of their own, one
+    per book under a common root. A book's folder is removed as soon as its
+    result has been dealt with, so a long batch doesn't pile up unpacked
+    books on disk until calibre exits.
+    '''
+    def __init__(self):
+        self.root = None
+        self.dirs = {}
+
+    def make(self, key):
+        if self.root is None:
+            self.root = PersistentTemporaryDirectory('_kindleunpack')
+        self.dirs[key] = tempfile.mkdtemp(dir=self.root)
+        return self.dirs[key]
+
+    def discard(self, key):
+        outdir = self.dirs.pop(key, None)
+        if outdir is not None:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+    def clear(self):
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+        self.root = None
+        self.dirs = {}
+
+
+class SerialExtractor:
+    '''
+    Runs the operation (see api.OPERATIONS) on each book in the calling
+    thread as soon as it is submitted. Without an outdir, each book gets a
+    scratch folder of its own that lasts until discard(key) or cleanup().
+    '''
+    def __init__(self):
+        self.done = []
+        self.scratch = ScratchSpace()
+
+    def submit(self, key, kindle_obj, operation, outdir=None, output='all'):
+        try:
+            self.done.append((key, run_operation(kindle_obj, operation, outdir or self.scratch.make(key), output), None))
+        except Exception as e:
+            traceback.print_exc()
+            self.done.append((key, None, str(e)))
+
+    def finished(self):
+        '''
+        Return the (key, result, errmsg) results that have come in since the last call.
+        '''
+        done, self.done = self.done, []
+        return done
+
+    def drain(self, abort):
+        return self.finished()
+
+    def discard(self, key):
+        '''
+        Remove the scratch folder holding key's result once it has been used.
+        '''
+        self.scratch.discard(key)
+
+    def close(self):
+        pass
+
+    def cleanup(self):
+        self.scratch.clear()
+
+
+class PoolExtractor:
+    '''
+    Farms the books out to a pool of calibre worker processes. Each worker
+    handles one book at a time in its own folder and only the path(s) of the
+    result come back, so the library is still updated serially by the caller.
+    At most two books per worker are kept in flight so that progress
+    reporting and Cancel stay close to what the workers are actually doing.
+    The workers already keep every core busy, so they never decompress a
+    book's text in parallel themselves (see mobi_text).
+    '''
+    def __init__(self, pool_size):
+        from calibre.utils.ipc.server import Server
+        self.server = Server(pool_size=pool_size)
+        self.pool_size = self.server.pool_size
+        self.pending = {}
+        self.done = []
+        self.scratch = ScratchSpace()
+
+    def submit(self, key, kindle_obj, operation, outdir=None, output='all'):
+        from calibre.utils.ipc.job import ParallelJob
+        while len(self.pending) >= 2 * self.pool_size:
+            self.collect(block=True)
+        args = [WORKER_MODULE, 'do_extract_worker', (kindle_obj.infile, operation, outdir or self.scratch.make(key),
+                                                     kindle_obj.ePubVersion, kindle_obj.useHDImages,
+                                                     kindle_obj.preferSource, output)]
+        job = ParallelJob('arbitrary', str(key[0]), done=None, args=args)
+        self.pending[job] = key
+        self.server.add_job(job)
+
+    def collect(self, block=False):
+        for job in finished_jobs(self.server, self.pending, block):
+            key = self.pending.pop(job)
+            if job.failed or job.result is None:
+                print(job.details)
+                self.done.append((key, None, 'Worker process failed'))
+            else:
+                result, errmsg = job.result
+                self.done.append((key, result, errmsg))
+
+    def finished(self):
+        self.collect()
+        done, self.done = self.done, []
+        return done
+
+    def drain(self, abort):
+        '''
+        Wait for every submitted book, unless abort gets set along the way.
+        '''
+        while self.pending and not abort.is_set():
+            self.collect(block=True)
+        return self.finished()
+
+    def discard(self, key):
+        self.scratch.discard(key)
+
+    def close(self):
+        for job in self.pending:
+            self.server.kill_job(job)
+        self.server.close()
+
+    def cleanup(self):
+        self.scratch.clear()
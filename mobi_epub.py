@@ -0,0 +1,387 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+#####################################################################
+# In-memory staging for the KindleUnpack core's EPUB output.
+#
+# To rebuild an EPUB the core writes the whole book out as files (the
+# resources under mobi7/Images, the parts, styles, OPF, NCX and nav
+# under mobi8/OEBPS) and then zips mobi8 up in fileNames.makeEPUB.
+# install_virtual_files() gives the core's modules their own open, os,
+# shutil, zipfile and unipath, which keep everything under a folder
+# registered with virtual_folder() in memory. The only thing that gets
+# written is then the EPUB itself, through a zipfile.ZipFile on the
+# caller's stream. Paths outside a registered folder go to the real
+# functions untouched.
+#
+# A registered folder doesn't exist on disk, so anything that reaches
+# it some other way fails with an EnvironmentError rather than going
+# unnoticed, and the caller can unpack on disk instead.
+#####################################################################
+
+import io
+import os
+import sys
+import time
+import errno
+import types
+import shutil
+import zipfile
+from threading import Lock
+from contextlib import contextmanager
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+CORE_PACKAGE = 'calibre_plugins.kindleunpack_plugin.kindleunpackcore'
+# unipath functions that have to know about registered folders.
+UNIPATH_FUNCTIONS = ('exists', 'isfile', 'isdir', 'mkdir', 'listdir', 'walk')
+
+text_type = type('')
+_folders = {}
+_folders_lock = Lock()
+
+
+def norm(path):
+    if isinstance(path, bytes):
+        path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return os.path.normpath(path)
+
+def lookup(path):
+    '''
+    Return (folder, normalized path) if path lies in a registered folder,
+    else (None, None).
+    '''
+    if not _folders or not isinstance(path, (bytes, text_type)):
+        return None, None
+    path = norm(path)
+    for folder in list(_folders.values()):
+        if folder.contains(path):
+            return folder, path
+    return None, None
+
+def missing(path, code=errno.ENOENT):
+    return IOError(code, os.strerror(code), path)
+
+
+class VirtualFile(io.BytesIO):
+    '''
+    A file being written in a VirtualFolder. What has been written so far is
+    what the folder shows for it, closed or not.
+    '''
+    def __init__(self, folder, path, data=b''):
+        io.BytesIO.__init__(self, data)
+        self.seek(0, os.SEEK_END)
+        self.folder, self.path = folder, path
+
+    def close(self):
+        if not self.closed:
+            self.folder.store(self)
+        io.BytesIO.close(self)
+
+
+class VirtualFolder:
+    '''
+    The files and folders under root, kept in memory. outputs maps the paths
+    of files that should go to a real stream instead (see setOutput).
+    '''
+    def __init__(self, root):
+        self.root = norm(root)
+        self.files = {}
+        self.dirs = set([self.root])
+        self.writing = {}
+        self.outputs = {}
+
+    def contains(self, path):
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def setOutput(self, path, stream):
+        self.outputs[norm(path)] = stream
+
+    def store(self, f):
+        self.files[f.path] = f.getvalue()
+        if self.writing.get(f.path) is f:
+            del self.writing[f.path]
+
+    def sync(self):
+        # Files that were written but never closed (the core sometimes leaves
+        # that to the garbage collector).
+        for f in list(self.writing.values()):
+            if not f.closed:
+                self.files[f.path] = f.getvalue()
+
+    def parent(self, path):
+        parent = os.path.dirname(path)
+        if parent not in self.dirs:
+            raise missing(parent)
+        return parent
+
+    def open(self, path, mode='r'):
+        if 'b' not in mode or '+' in mode or 'x' in mode:
+            raise missing(path, errno.EINVAL)
+        self.sync()
+        if 'r' in mode:
+            if path in self.dirs:
+                raise missing(path, errno.EISDIR)
+            if path not in self.files:
+                raise missing(path)
+            return io.BytesIO(self.files[path])
+        self.parent(path)
+        if path in self.dirs:
+            raise missing(path, errno.EISDIR)
+        f = VirtualFile(self, path, self.files.get(path, b'') if 'a' in mode else b'')
+        self.files[path] = f.getvalue()
+        self.writing[path] = f
+        return f
+
+    def exists(self, path):
+        return path in self.dirs or path in self.files
+
+    def isfile(self, path):
+        return path in self.files
+
+    def isdir(self, path):
+        return path in self.dirs
+
+    def getsize(self, path):
+        self.sync()
+        if path not in self.files:
+            raise missing(path)
+        return len(self.files[path])
+
+    def mkdir(self, path, *args):
+        if self.exists(path):
+            raise missing(path, errno.EEXIST)
+        self.parent(path)
+        self.dirs.add(path)
+
+    def makedirs(self, path, mode=0o777, exist_ok=False):
+        if self.exists(path) and not (exist_ok and path in self.dirs):
+            raise missing(path, errno.EEXIST)
+        while path not in self.dirs:
+            self.dirs.add(path)
+            path = os.path.dirname(path)
+
+    def listdir(self, path):
+        if path not in self.dirs:
+            raise missing(path)
+        return sorted(os.path.basename(p) for p in list(self.dirs) + list(self.files)
+                      if p != path and os.path.dirname(p) == path)
+
+    def walk(self, top, *args, **kwargs):
+        if top not in self.dirs:
+            return
+        names = self.listdir(top)
+        dirnames = [name for name in names if os.path.join(top, name) in self.dirs]
+        yield top, dirnames, [name for name in names if name not in dirnames]
+        for name in dirnames:
+            for entry in self.walk(os.path.join(top, name)):
+                yield entry
+
+    def remove(self, path):
+        if path not in self.files:
+            raise missing(path, errno.EISDIR if path in self.dirs else errno.ENOENT)
+        del self.files[path]
+        self.writing.pop(path, None)
+
+    def rmdir(self, path):
+        if path not in self.dirs:
+            raise missing(path)
+        if self.listdir(path):
+            raise missing(path, errno.ENOTEMPTY)
+        self.dirs.discard(path)
+
+    def rmtree(self, path):
+        if path not in self.dirs:
+            raise missing(path)
+        inside = path + os.sep
+        self.files = dict((p, data) for p, data in self.files.items() if not p.startswith(inside))
+        self.dirs = set(p for p in self.dirs if p != path and not p.startswith(inside))
+
+    def zipTarget(self, path, mode):
+        # What a zipfile.ZipFile on path should read from or write to.
+        if mode == 'w':
+            if path in self.outputs:
+                return self.outputs[path]
+            return self.open(path, 'wb')
+        return self.open(path, 'rb')
+
+
+@contextmanager
+def virtual_folder(root):
+    '''
+    Keep the files the core writes under root in memory while the block runs.
+    root must not exist on disk. Yields the VirtualFolder.
+    '''
+    folder = VirtualFolder(root)
+    with _folders_lock:
+        _folders[folder.root] = folder
+    try:
+        yield folder
+    finally:
+        with _folders_lock:
+            del _folders[folder.root]
+
+
+def virtual(name, real):
+    '''
+    Wrap real, a function taking a path first, so that it calls the
+    VirtualFolder method name instead for paths in a registered folder.
+    '''
+    def wrapper(path, *args, **kwargs):
+        folder, vpath = lookup(path)
+        if folder is None:
+            return real(path, *args, **kwargs)
+        return getattr(folder, name)(vpath, *args, **kwargs)
+    wrapper.__name__ = str(name)
+    wrapper.virtual = True
+    return wrapper
+
+def virtual_open(real):
+    def open(file, mode='r', *args, **kwargs):
+        folder, path = lookup(file)
+        if folder is None:
+            return real(file, mode, *args, **kwargs)
+        return folder.open(path, mode)
+    open.virtual = True
+    return open
+
+def copyfile(src, dst, *args, **kwargs):
+    if lookup(src)[0] is None and lookup(dst)[0] is None:
+        return shutil.copyfile(src, dst, *args, **kwargs)
+    with virtual_open(builtins.open)(src, 'rb') as fsrc:
+        data = fsrc.read()
+    with virtual_open(builtins.open)(dst, 'wb') as fdst:
+        fdst.write(data)
+    return dst
+
+def copy(src, dst, *args, **kwargs):
+    if lookup(src)[0] is None and lookup(dst)[0] is None:
+        return shutil.copy(src, dst, *args, **kwargs)
+    if os_module.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    return copyfile(src, dst)
+
+def rmtree(path, ignore_errors=False, *args, **kwargs):
+    folder, vpath = lookup(path)
+    if folder is None:
+        return shutil.rmtree(path, ignore_errors, *args, **kwargs)
+    try:
+        folder.rmtree(vpath)
+    except EnvironmentError:
+        if not ignore_errors:
+            raise
+
+
+class VirtualZipFile(zipfile.ZipFile):
+    '''
+    zipfile.ZipFile that can be opened on, and add files from, a registered
+    folder. A zip written to a path given to VirtualFolder.setOutput goes to
+    that stream.
+    '''
+    def __init__(self, file, mode='r', *args, **kwargs):
+        folder, path = lookup(file)
+        if folder is not None:
+            file = folder.zipTarget(path, mode)
+        zipfile.ZipFile.__init__(self, file, mode, *args, **kwargs)
+
+    def write(self, filename, arcname=None, compress_type=None, *args, **kwargs):
+        folder, path = lookup(filename)
+        if folder is None:
+            return zipfile.ZipFile.write(self, filename, arcname, compress_type, *args, **kwargs)
+        # As ZipFile.write names and dates the entry.
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname and arcname[:1] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        isdir = folder.isdir(path)
+        if isdir:
+            arcname += '/'
+            data = b''
+        else:
+            with folder.open(path, 'rb') as f:
+                data = f.read()
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        if isdir:
+            zinfo.external_attr = (0o40755 << 16) | 0x10
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.external_attr = 0o100644 << 16
+            zinfo.compress_type = self.compression if compress_type is None else compress_type
+        self.writestr(zinfo, data)
+
+
+def proxy_module(module, names, **overrides):
+    '''
+    A copy of module whose functions listed in names go through virtual,
+    with overrides replacing some attributes outright.
+    '''
+    proxy = types.ModuleType(str(module.__name__))
+    proxy.__dict__.update(module.__dict__)
+    for name in names:
+        setattr(proxy, name, virtual(name, getattr(module, name)))
+    proxy.__dict__.update(overrides)
+    return proxy
+
+
+os_path_module = proxy_module(os.path, ('exists', 'isfile', 'isdir', 'getsize'),
+                              lexists=virtual('exists', os.path.lexists))
+os_module = proxy_module(os, ('mkdir', 'makedirs', 'listdir', 'remove', 'rmdir', 'walk'),
+                         unlink=virtual('remove', os.unlink), path=os_path_module)
+shutil_module = proxy_module(shutil, (), copyfile=copyfile, copy=copy, copy2=copy, rmtree=rmtree)
+zipfile_module = proxy_module(zipfile, (), ZipFile=VirtualZipFile)
+_replacements = {os: os_module, os.path: os_path_module, shutil: shutil_module, zipfile: zipfile_module,
+                 zipfile.ZipFile: VirtualZipFile}
+
+def patch_module(module, unipath=None):
+    '''
+    Point module's globals for open, os, os.path, shutil and zipfile (and
+    anything it imported from unipath by name) at the versions above.
+    '''
+    namespace = vars(module)
+    if not getattr(namespace.get('open'), 'virtual', False):
+        namespace['open'] = virtual_open(namespace.get('open', builtins.open))
+    for name, value in list(namespace.items()):
+        try:
+            replacement = _replacements.get(value)
+        except TypeError:
+            # Unhashable.
+            continue
+        if replacement is not None:
+            namespace[name] = replacement
+        elif unipath is not None and name in UNIPATH_FUNCTIONS and value is unipath.originals.get(name):
+            namespace[name] = getattr(unipath, name)
+
+def patch_unipath(unipath):
+    unipath.originals = {}
+    for name in UNIPATH_FUNCTIONS:
+        real = getattr(unipath, name, None)
+        if real is not None:
+            unipath.originals[name] = real
+            setattr(unipath, name, virtual(name, real))
+
+
+_installed = False
+
+def install_virtual_files():
+    '''
+    Patch every loaded module of the core (see patch_module). Called by
+    mobi_stuff.unpackCore once the core is imported.
+    '''
+    global _installed
+    if _installed:
+        return
+    unipath = sys.modules.get(CORE_PACKAGE + '.unipath')
+    if unipath is not None:
+        patch_unipath(unipath)
+    for name, module in list(sys.modules.items()):
+        if module is not None and name.startswith(CORE_PACKAGE + '.') and module is not unipath:
+            patch_module(module, unipath)
+    _installed = True
@@ -0,0 +1,163 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+#####################################################################
+# INDX decoding for the KindleUnpack core.
+#
+# Every NCX, skeleton, fragment, guide and dictionary entry goes
+# through the core's mobi_index.getTagMap, which works out from the
+# TAGX table which tags an entry has and reads their variable width
+# values one byte slice at a time. install_index_decoder() swaps in a
+# decoder that works the TAGX table out once per index and decodes
+# each entry from a single copy of its bytes. It also keeps each
+# decoded index for the rest of the book, so the parts of the core
+# that look at the same index don't parse its records again.
+#####################################################################
+
+import binascii
+
+_tag_plans = {}
+
+def tag_plan(controlByteCount, tagTable):
+    '''
+    The TAGX table as (tag, values per entry, mask, shift, multibit, control
+    byte index) for each tag, worked out once per distinct table.
+    '''
+    key = (controlByteCount, tuple(tagTable))
+    plan = _tag_plans.get(key)
+    if plan is None:
+        plan = []
+        controlByteIndex = 0
+        for tag, valuesPerEntry, mask, endFlag in tagTable:
+            if endFlag == 0x01:
+                controlByteIndex += 1
+                continue
+            shift = 0
+            while mask and not (mask >> shift) & 0x01:
+                shift += 1
+            plan.append((tag, valuesPerEntry, mask, shift, bin(mask).count('1') > 1, controlByteIndex))
+        plan = _tag_plans[key] = tuple(plan)
+    return plan
+
+def decode_entry(plan, controlByteCount, entry, endPos):
+    '''
+    Decode the tags of one index entry, whose control bytes start entry. Raises
+    IndexError if the values run past the end of entry.
+    '''
+    pos = controlByteCount
+    tags = []
+    for tag, valuesPerEntry, mask, shift, multibit, controlByteIndex in plan:
+        value = entry[controlByteIndex] & mask
+        if not value:
+            continue
+        if value == mask and multibit:
+            # All bits set: a variable width value after the control bytes
+            # gives the number of bytes (not values) the tag's values take.
+            size = 0
+            while True:
+                v = entry[pos]
+                pos += 1
+                size = (size << 7) | (v & 0x7f)
+                if v & 0x80:
+                    break
+            tags.append((tag, None, size, valuesPerEntry))
+        elif value == mask:
+            tags.append((tag, 1, None, valuesPerEntry))
+        else:
+            tags.append((tag, value >> shift, None, valuesPerEntry))
+    tagHashMap = {}
+    # Printed once the whole entry has decoded, so nothing is reported twice
+    # when the core has to decode it after all.
+    errors = []
+    for tag, valueCount, valueBytes, valuesPerEntry in tags:
+        values = []
+        if valueCount is not None:
+            for _ in range(valueCount * valuesPerEntry):
+                value = 0
+                while True:
+                    v = entry[pos]
+                    pos += 1
+                    value = (value << 7) | (v & 0x7f)
+                    if v & 0x80:
+                        break
+                values.append(value)
+        else:
+            start = pos
+            while pos - start < valueBytes:
+                value = 0
+                while True:
+                    v = entry[pos]
+                    pos += 1
+                    value = (value << 7) | (v & 0x7f)
+                    if v & 0x80:
+                        break
+                values.append(value)
+            if pos - start != valueBytes:
+                errors.append('Error: Should consume %s bytes, but consumed %s' % (valueBytes, pos - start))
+        tagHashMap[tag] = values
+    for error in errors:
+        print(error)
+    # The last entry might have some zero padding bytes, so only complain
+    # about non zero bytes left over, as the core does.
+    if endPos is not None and any(entry[pos:]):
+        print('Warning: There are unprocessed index bytes left: %s' % binascii.hexlify(bytes(entry[pos:])).decode('ascii'))
+    return tagHashMap
+
+def fast_getTagMap(getTagMap):
+    '''
+    Wrap the core's mobi_index.getTagMap. Entries that don't decode within
+    their own bytes (corrupt ones the core reads past the end of) are left
+    to the core so that the result is always the same.
+    '''
+    def wrapper(controlByteCount, tagTable, entryData, startPos, endPos=None):
+        entry = bytearray(entryData[startPos:endPos] if endPos is not None else entryData[startPos:])
+        try:
+            return decode_entry(tag_plan(controlByteCount, tagTable), controlByteCount, entry, endPos)
+        except IndexError:
+            return getTagMap(controlByteCount, tagTable, entryData, startPos, endPos)
+    return wrapper
+
+def cached_getIndexData(getIndexData):
+    '''
+    Wrap the core's MobiIndex.getIndexData so an index is decoded once per
+    book, for books unpacked through mobi_stuff (whose sectionizer carries
+    an indexCache). The entries themselves are shared between callers, which
+    only ever read them.
+    '''
+    def wrapper(self, idx, *args, **kwargs):
+        cache = getattr(self.sect, 'indexCache', None)
+        if cache is None:
+            return getIndexData(self, idx, *args, **kwargs)
+        if idx not in cache:
+            cache[idx] = getIndexData(self, idx, *args, **kwargs)
+        outtbl, ctoc_text = cache[idx]
+        return list(outtbl), dict(ctoc_text)
+    return wrapper
+
+
+_installed = False
+
+def install_index_decoder():
+    '''
+    Point the core at the decoder and index cache above. Called by
+    mobi_stuff.unpackCore before the core unpacks anything.
+    '''
+    global _installed
+    if _installed:
+        return
+    from calibre_plugins.kindleunpack_plugin.kindleunpackcore import mobi_index
+    getTagMap = fast_getTagMap(mobi_index.getTagMap)
+    mobi_index.getTagMap = getTagMap
+    try:
+        # The dictionary code imports getTagMap by name.
+        from calibre_plugins.kindleunpack_plugin.kindleunpackcore import mobi_dict
+        if hasattr(mobi_dict, 'getTagMap'):
+            mobi_dict.getTagMap = getTagMap
+    except ImportError:
+        pass
+    mobi_index.MobiIndex.getIndexData = cached_getIndexData(mobi_index.MobiIndex.getIndexData)
+    _installed = True
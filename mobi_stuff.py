@@ -6,39 +6,144 @@ __license__   = 'GPL v3'
 __docformat__ = 'restructuredtext en'
 
 import os
+import mmap
 import struct
 import re
+import shutil
+import zipfile
+import tempfile
+from uuid import uuid4
+from array import array
+from bisect import bisect_right
 from io import open
 
-import calibre_plugins.kindleunpack_plugin.config as cfg
-import calibre_plugins.kindleunpack_plugin.kindleunpackcore.kindleunpack as _mu
 from calibre_plugins.kindleunpack_plugin.kindleunpackcore.compatibility_utils import PY2, bstr, unicode_str
-from calibre_plugins.kindleunpack_plugin.kindleunpackcore.mobi_split import mobi_split
 
 
 if PY2:
     range = xrange
 
+def unpackCore():
+    """ The KindleUnpack core, imported the first time a book actually needs
+        unpacking rather than whenever calibre loads the plugin. Probing
+        never needs it; PDF extraction and combo splitting only load it when
+        they fall back to unpackBook and mobi_split. The core's text
+        decompression and index decoding are swapped for the plugin's own
+        (see mobi_text and mobi_indexes), and its file output is made able
+        to stay in memory (see mobi_epub), at the same time. """
+    import calibre_plugins.kindleunpack_plugin.kindleunpackcore.kindleunpack as _mu
+    from calibre_plugins.kindleunpack_plugin.mobi_text import install_backends
+    from calibre_plugins.kindleunpack_plugin.mobi_indexes import install_index_decoder
+    from calibre_plugins.kindleunpack_plugin.mobi_epub import install_virtual_files
+    install_backends()
+    install_index_decoder()
+    install_virtual_files()
+    return _mu
+
 class SectionizerLight:
-    """ Stolen from Mobi_Unpack and slightly modified. """
+    """ Stolen from Mobi_Unpack and slightly modified.
+        Only the Palm header and the section offset table are read up front.
+        Records are fetched on demand with positioned reads, so probing a book
+        costs the same small amount of I/O regardless of its size. """
     def __init__(self, filename):
-        self.data = open(filename, 'rb').read()
-        if self.data[:3] == b'TPZ':
+        self.stream = open(filename, 'rb')
+        self.palmheader = self.stream.read(78)
+        if self.palmheader[:3] == b'TPZ':
             self.ident = 'TPZ'
-        else:
-            self.palmheader = self.data[:78]
-            self.ident = self.palmheader[0x3C:0x3C+8]
+            return
+        self.ident = self.palmheader[0x3C:0x3C+8]
         try:
             self.num_sections, = struct.unpack_from(b'>H', self.palmheader, 76)
         except:
             return
-        self.filelength = len(self.data)
+        self.stream.seek(0, os.SEEK_END)
+        self.filelength = self.stream.tell()
         try:
-            sectionsdata = struct.unpack_from(bstr('>%dL' % (self.num_sections*2)), self.data, 78) + (self.filelength, 0)
+            self.stream.seek(78)
+            tabledata = self.stream.read(self.num_sections*8)
+            sectionsdata = struct.unpack_from(bstr('>%dL' % (self.num_sections*2)), tabledata, 0) + (self.filelength, 0)
             self.sectionoffsets = sectionsdata[::2]
         except:
             pass
 
+    def loadSection(self, section, length=None):
+        before, after = self.sectionoffsets[section:section+2]
+        if length is not None:
+            after = min(after, before + length)
+        self.stream.seek(before)
+        return self.stream.read(after - before)
+
+    def close(self):
+        self.stream.close()
+
+class MappedSectionizer:
+    """ Memory-mapped counterpart of SectionizerLight used once an operation
+        actually starts. The file is opened and mapped a single time and
+        loadSection hands out memoryview slices of the map, so no section is
+        copied unless the caller asks for it. Python 2 can't view an mmap,
+        so there the sections are plain slices of the map. """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise Exception(_('Unrecognized Kindle/MOBI file format!'))
+        try:
+            self.view = memoryview(self.data)
+        except TypeError:
+            # Python 2's mmap has no buffer interface for memoryview, so
+            # sections are handed out as plain slices of the map instead.
+            self.view = self.data
+        self.palmheader = self.data[:78]
+        self.palmname = self.data[:32]
+        self.ident = self.palmheader[0x3C:0x3C+8]
+        self.num_sections, = struct.unpack_from(b'>H', self.palmheader, 76)
+        self.filelength = len(self.data)
+        sectionsdata = struct.unpack_from(bstr('>%dL' % (self.num_sections*2)), self.data, 78) + (self.filelength, 0)
+        self.sectionoffsets = sectionsdata[::2]
+        self.sectionattributes = sectionsdata[1::2]
+        self.sectiondescriptions = ['' for x in range(self.num_sections+1)]
+        self.sectiondescriptions[-1] = 'File Length Only'
+
+    def setsectiondescription(self, section, description):
+        if section < len(self.sectiondescriptions):
+            self.sectiondescriptions[section] = description
+
+    def loadSection(self, section, length=None):
+        before, after = self.sectionoffsets[section:section+2]
+        if length is not None:
+            after = min(after, before + length)
+        return self.view[before:after]
+
+    def close(self):
+        if self.view is not self.data:
+            self.view.release()
+        try:
+            self.data.close()
+        except BufferError:
+            # A caller still holds a slice of the map. It will be unmapped
+            # when the last view of it is garbage collected.
+            pass
+
+class CoreSectionizer:
+    """ Presents a MappedSectionizer to the unpack core in place of its own
+        Sectionizer. The core treats sections as bytes, so each one is copied
+        out of the shared map only when the core asks for it rather than the
+        core reading the whole file into memory a second time. """
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.filename, self.data = mapped.filename, mapped.data
+        self.palmheader, self.palmname, self.ident = mapped.palmheader, mapped.palmname, mapped.ident
+        self.num_sections, self.filelength = mapped.num_sections, mapped.filelength
+        self.sectionoffsets, self.sectionattributes = mapped.sectionoffsets, mapped.sectionattributes
+        self.sectiondescriptions = mapped.sectiondescriptions
+        # Indexes the core has decoded so far, by section (see mobi_indexes).
+        self.indexCache = {}
+
+    def setsectiondescription(self, section, description):
+        self.mapped.setsectiondescription(section, description)
+
     def loadSection(self, section):
         before, after = self.sectionoffsets[section:section+2]
         return self.data[before:after]
@@ -51,8 +156,27 @@ class MobiHeaderLight:
         self.header = self.sect.loadSection(self.start)
         self.records, = struct.unpack_from(b'>H', self.header, 0x8)
         self.length, self.type, self.codepage, self.unique_id, self.version = struct.unpack(b'>LLLLL', self.header[20:40])
-        self.mlstart = self.sect.loadSection(self.start+1)[0:4]
+        self.mlstart = self.sect.loadSection(self.start+1, 4)
         self.crypto_type, = struct.unpack_from(b'>H', self.header, 0xC)
+        self.exth = self.parseEXTH()
+
+    def parseEXTH(self):
+        # Map of EXTH record type to the list of its values
+        exth = {}
+        try:
+            exth_flag, = struct.unpack_from(b'>L', self.header, 0x80)
+            exth_offset = 16 + self.length
+            if not exth_flag & 0x40 or self.header[exth_offset:exth_offset+4] != b'EXTH':
+                return exth
+            num_items, = struct.unpack_from(b'>L', self.header, exth_offset+8)
+            pos = exth_offset + 12
+            for i in range(num_items):
+                exth_id, size = struct.unpack_from(b'>LL', self.header, pos)
+                exth.setdefault(exth_id, []).append(self.header[pos+8:pos+size])
+                pos += size
+        except struct.error:
+            pass
+        return exth
 
     def isEncrypted(self):
         return self.crypto_type != 0
@@ -64,16 +188,406 @@ class MobiHeaderLight:
     def isKF8(self):
         return self.start != 0 or self.version == 8
 
+    def isBoundary(self, section):
+        before, after = self.sect.sectionoffsets[section:section+2]
+        return (after - before) == 8 and self.sect.loadSection(section) == b'BOUNDARY'
+
+    def getKF8Boundary(self):
+        # Index of the BOUNDARY section of a joint MOBI/KF8 file, or -1.
+        if self.version == 8:
+            return -1
+        # EXTH 121 holds the section number of the KF8 header, which
+        # immediately follows the BOUNDARY section.
+        if 121 in self.exth:
+            kf8start, = struct.unpack_from(b'>L', self.exth[121][0], 0)
+            if kf8start == 0xffffffff:
+                return -1
+            if 0 < kf8start < self.sect.num_sections and self.isBoundary(kf8start-1):
+                return kf8start - 1
+        # No usable EXTH entry; fall back to looking at the 8 byte sections
+        # that follow the text records.
+        for i in range(self.start + self.records + 1, len(self.sect.sectionoffsets)-1):
+            if self.isBoundary(i):
+                return i
+        return -1
+
     def isJointFile(self):
         # Check for joint MOBI/KF8
-        for i in range(len(self.sect.sectionoffsets)-1):
-            before, after = self.sect.sectionoffsets[i:i+2]
-            if (after - before) == 8:
-                data = self.sect.loadSection(i)
-                if data == b'BOUNDARY' and self.version != 8:
-                    return True
+        return self.getKF8Boundary() != -1
+
+    def getSourceSection(self):
+        # Section holding the kindlegen source archive (SRCS), or -1.
+        if 16 + self.length < 0xE8 or len(self.header) < 0xE8:
+            return -1
+        srcs, count = struct.unpack_from(b'>LL', self.header, 0xE0)
+        if srcs == 0xffffffff or count == 0:
+            return -1
+        section = self.start + srcs
+        if section >= self.sect.num_sections or self.sect.loadSection(section, 4) != b'SRCS':
+            return -1
+        return section
+
+    def getCompression(self):
+        compression, = struct.unpack_from(b'>H', self.header, 0x0)
+        return compression
+
+    def getExtraDataFlags(self):
+        # (multibyte, trailers) worked out exactly as the core's getRawML does.
+        multibyte = trailers = 0
+        if self.sect.ident == b'BOOKMOBI':
+            mobi_version, = struct.unpack_from(b'>L', self.header, 0x68)
+            if self.length >= 0xE4 and mobi_version >= 5:
+                flags, = struct.unpack_from(b'>H', self.header, 0xF2)
+                multibyte = flags & 1
+                while flags > 1:
+                    if flags & 2:
+                        trailers += 1
+                    flags = flags >> 1
+        return multibyte, trailers
+
+    def getTextRecordRanges(self):
+        # (file offset, length) of each text record once its trailing entries
+        # are trimmed off.
+        multibyte, trailers = self.getExtraDataFlags()
+        offsets = self.sect.sectionoffsets[self.start+1:self.start+self.records+2]
+        return list(zip(offsets, trimmedLengths(self.sect.data, offsets, multibyte, trailers)))
+
+
+# Bytes read from the end of a text record at a time while sizing its
+# trailing entries. Enough for all of them in any real book.
+TRAILER_WINDOW = 32
+
+def trimmedLengths(data, offsets, multibyte, trailers):
+    """ Lengths of the records between consecutive offsets of the mapped book
+        data once their trailing entries are trimmed off, exactly as the
+        core's getRawML trims them, in a single pass over the section table.
+        Each record's tail is read once rather than once per trailing entry. """
+    lengths = array(str('L'))
+    for i in range(len(offsets) - 1):
+        before, after = offsets[i], offsets[i+1]
+        tailstart = max(before, after - TRAILER_WINDOW)
+        tail = bytearray(data[tailstart:after])
+        end = after
+        for j in range(trailers):
+            if max(before, end - 4) < tailstart:
+                tailstart = max(before, end - TRAILER_WINDOW)
+                tail = bytearray(data[tailstart:end])
+            num = 0
+            for v in tail[max(before, end - 4) - tailstart:end - tailstart]:
+                if v & 0x80:
+                    num = 0
+                num = (num << 7) | (v & 0x7f)
+            # The core trims with data[:-num], so a size of 0 empties the record.
+            end = end - num if 0 < num < end - before else before
+        if multibyte and end > before:
+            if end - 1 < tailstart:
+                tailstart = end - 1
+                tail = bytearray(data[tailstart:end])
+            end = max(before, end - ((tail[end - 1 - tailstart] & 3) + 1))
+        lengths.append(end - before)
+    return lengths
+
+
+# What unpackBook produces. 'epub' skips rebuilding the MOBI7 half of a
+# combo book and 'mobi7' skips the KF8 half. Raw dumps are always off.
+OUTPUTS = ('all', 'epub', 'mobi7')
+
+def unpackBook(sect, infile, outdir, epubver='2', use_hd=False, K8Boundary=None, output='all', parallel_records=0):
+    """ kindleunpack.unpackBook, minus the option globals, driven from an
+        already-mapped book instead of having the core read the file again.
+        K8Boundary is the BOUNDARY section found while probing (-1 for none),
+        or None to have it looked up here. output is one of OUTPUTS. Text
+        with at least parallel_records records (0 for never) is decompressed
+        by a pool of worker processes, see mobi_text. """
+    if output not in OUTPUTS:
+        raise ValueError('Unknown output: {0}'.format(output))
+    _mu = unpackCore()
+    infile, outdir = unicode_str(infile), unicode_str(outdir)
+    files = _mu.fileNames(infile, outdir)
+    coresect = CoreSectionizer(sect)
+    if coresect.ident != b'BOOKMOBI' and coresect.ident != b'TEXtREAd':
+        raise _mu.unpackException('Invalid file format')
+    mh = _mu.MobiHeader(coresect, 0)
+    mhlst = [mh]
+    hasK8 = mh.isK8()
+    if hasK8:
+        K8Boundary = -1
+    else:
+        # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
+        if K8Boundary is None:
+            K8Boundary = MobiHeaderLight(sect, 0).getKF8Boundary()
+        if K8Boundary != -1:
+            sect.setsectiondescription(K8Boundary, 'Mobi/KF8 Boundary Section')
+            if output != 'mobi7':
+                mhlst.append(_mu.MobiHeader(coresect, K8Boundary+1))
+                hasK8 = True
+    if output == 'epub' and not hasK8:
+        raise _mu.unpackException('No KF8 content to rebuild an ePub from')
+    if output == 'mobi7' and mh.isK8():
+        raise _mu.unpackException('No MOBI7 content in a standalone KF8 book')
+    if hasK8:
+        files.makeK8Struct()
+    for header in mhlst:
+        header.parallelRecords = parallel_records
+    # The MOBI7 header stays in the list for an ePub so that the resources
+    # shared with the KF8 half are still found; k8only stops the core from
+    # rebuilding the MOBI7 book itself.
+    _mu.process_all_mobi_headers(files, None, coresect, mhlst, K8Boundary, output == 'epub', epubver, use_hd)
+
+
+class RawMLMap:
+    """ Maps offsets in the rawML of an uncompressed book, the text records
+        joined end to end, back to byte ranges of the book file so parts of
+        it can be read or copied without building the rawML at all. """
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.starts = []
+        pos = 0
+        for offset, length in ranges:
+            self.starts.append(pos)
+            pos += length
+        self.length = pos
+
+    def fileRanges(self, start, length):
+        if start < 0 or length < 0 or start + length > self.length:
+            raise ValueError('rawML range out of bounds')
+        pieces = []
+        i = bisect_right(self.starts, start) - 1
+        while length > 0:
+            offset, reclength = self.ranges[i]
+            skip = start - self.starts[i]
+            count = min(reclength - skip, length)
+            if count > 0:
+                pieces.append((offset + skip, count))
+            start += count
+            length -= count
+            i += 1
+        return pieces
+
+    def read(self, data, start, length):
+        return b''.join(data[offset:offset+count] for offset, count in self.fileRanges(start, length))
+
+
+def copyFileRanges(infile, view, ranges, outfile):
+    """ Write the (offset, length) byte ranges of infile to outfile. The kernel
+        does the copying (copy_file_range, else sendfile) where it can;
+        otherwise the slices of view, the mapped infile, are written out.
+        Entries of ranges may also be bytes, which are written as they are. """
+    kernel_copy = getattr(os, 'copy_file_range', None)
+    if kernel_copy is None and hasattr(os, 'sendfile'):
+        def kernel_copy(src, dst, count, offset):
+            return os.sendfile(dst, src, offset, count)
+
+    def writeAll(dst, data):
+        # dst is unbuffered, so a write may take only part of data.
+        data = memoryview(data)
+        while len(data):
+            data = data[dst.write(data):]
+
+    with open(infile, 'rb') as src, open(outfile, 'wb', buffering=0) as dst:
+        for piece in ranges:
+            if not isinstance(piece, tuple):
+                writeAll(dst, piece)
+                continue
+            offset, length = piece
+            while length > 0 and kernel_copy is not None:
+                try:
+                    copied = kernel_copy(src.fileno(), dst.fileno(), length, offset)
+                except OSError:
+                    # Not supported between these files; write the rest.
+                    copied = 0
+                if not copied:
+                    kernel_copy = None
                     break
+                offset += copied
+                length -= copied
+            if length > 0:
+                writeAll(dst, view[offset:offset+length])
+
+def extractPrintReplicaPDF(sect, infile, outdir):
+    """ Copy the PDF of a Print Replica book straight out of the mapped book
+        into outdir, named as the core's processPrintReplica would name it.
+        Returns its path, or None if the text isn't stored uncompressed (the
+        usual case for AZW4), in which case the book has to be unpacked. """
+    mhl = MobiHeaderLight(sect, 0)
+    if mhl.isEncrypted() or mhl.getCompression() != 1 or not mhl.isPrintReplica():
+        return None
+    rawml = RawMLMap(mhl.getTextRecordRanges())
+    # %MOP, table count, section count per table, then an (offset, length)
+    # pair per section. The first section of each table is a PDF.
+    numTables, = struct.unpack(b'>L', rawml.read(sect.data, 4, 4))
+    if numTables == 0:
+        return None
+    tableIndexOffset = 8 + 4*numTables
+    sectionOffset, sectionLength = struct.unpack(b'>LL', rawml.read(sect.data, tableIndexOffset, 8))
+    pdf = os.path.join(outdir, os.path.splitext(os.path.basename(infile))[0] + '.001.pdf')
+    copyFileRanges(infile, sect.view, rawml.fileRanges(sectionOffset, sectionLength), pdf)
+    return pdf
+
+
+def sourceEPUB(archive, epub):
+    """ Save the EPUB a kindlegen source archive was built from as epub. That's
+        either the archive itself (kindlegen was given an unzipped EPUB) or
+        the one .epub inside it. Returns False if it holds anything else. """
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            names = zf.namelist()
+            if 'mimetype' in names and zf.read('mimetype').strip() == b'application/epub+zip':
+                inner = None
+            else:
+                inner = [name for name in names if name.lower().endswith('.epub')]
+                if len(inner) != 1:
+                    return False
+                inner = inner[0]
+                with zf.open(inner) as src, open(epub, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+    except zipfile.BadZipfile:
         return False
+    if inner is None:
+        shutil.copyfile(archive, epub)
+    elif not zipfile.is_zipfile(epub):
+        os.remove(epub)
+        return False
+    return True
+
+
+def rewriteEXTH(rec0, edit):
+    """ Return rec0 with its EXTH records replaced by edit(records), records
+        being the list of (id, data) pairs in the block. The title offset
+        is moved along with anything that follows the block. """
+    length, = struct.unpack_from(b'>L', rec0, 20)
+    ebase = 16 + length
+    if rec0[ebase:ebase+4] != b'EXTH':
+        return rec0
+    eblen, count = struct.unpack_from(b'>LL', rec0, ebase+4)
+    records = []
+    pos = ebase + 12
+    for i in range(count):
+        exth_id, size = struct.unpack_from(b'>LL', rec0, pos)
+        records.append((exth_id, rec0[pos+8:pos+size]))
+        pos += size
+    records = edit(records)
+    body = b''.join(struct.pack(b'>LL', exth_id, len(data)+8) + data for exth_id, data in records)
+    # Keep whatever eblen counted beyond the records themselves (padding).
+    body += rec0[pos:ebase+eblen]
+    block = b'EXTH' + struct.pack(b'>LL', 12 + len(body), len(records)) + body
+    rec0 = rec0[:ebase] + block + rec0[ebase+eblen:]
+    title_offset, = struct.unpack_from(b'>L', rec0, 0x54)
+    return rec0[:0x54] + struct.pack(b'>L', title_offset + len(block) - eblen) + rec0[0x58:]
+
+def replaceEXTH(records, exth_id, data):
+    # As mobi_split's replaceexth: the first exth_id record (if any) is
+    # dropped and the new one goes in front of the others.
+    for i, (record_id, _) in enumerate(records):
+        if record_id == exth_id:
+            records = records[:i] + records[i+1:]
+            break
+    return [(exth_id, data)] + records
+
+def setLong(rec0, offset, value):
+    return rec0[:offset] + struct.pack(b'>L', value) + rec0[offset+4:]
+
+def headerIndexes(rec0, offsets):
+    # (offset, value) of the section index fields at offsets that lie inside
+    # the MOBI header. A short header has no DATP field, for instance.
+    length, = struct.unpack_from(b'>L', rec0, 20)
+    return [(offset,) + struct.unpack_from(b'>L', rec0, offset) for offset in offsets if offset + 4 <= 16 + length]
+
+def splitCombo(sect, kf8start):
+    """ Plan the standalone MOBI7 and KF8 books mobi_split makes of a combo
+        book without building either. Each is returned as its list of
+        sections: the index of a section of sect to copy as is, or the bytes
+        of a rewritten (or emptied) one. The one difference from mobi_split
+        is that resources are never taken from past the BOUNDARY section,
+        which only a damaged header would ask for. """
+    n = sect.num_sections
+    rec0 = sect.loadSection(0).tobytes()
+
+    # MOBI7: everything up to the BOUNDARY section, plus the final EOF section,
+    # minus any kindlegen source archive.
+    mobi7 = list(range(0, kf8start - 1)) + [n - 1]
+    srcs, num_srcs = struct.unpack_from(b'>LL', rec0, 0xE0)
+    if srcs != 0xffffffff and num_srcs > 0:
+        del mobi7[srcs:srcs+num_srcs]
+        rec0 = setLong(setLong(rec0, 0xE0, 0xffffffff), 0xE4, 0)
+
+    # No KF8 part (EXTH 121) and no KF8 cover (EXTH 129) any more.
+    def edit7(records):
+        return replaceEXTH(replaceEXTH(records, 121, struct.pack(b'>L', 0xffffffff)), 129, b'')
+    rec0 = rewriteEXTH(rec0, edit7)
+    # Drop the shared resources (0x0800) and embedded fonts (0x1000) flags.
+    flags, = struct.unpack_from(b'>L', rec0, 0x80)
+    rec0 = setLong(rec0, 0x80, flags & 0x07FF)
+    mobi7[0] = rec0
+
+    firstimage, = struct.unpack_from(b'>L', rec0, 0x6C)
+    lastimage, = struct.unpack_from(b'>H', rec0, 0xC2)
+    if lastimage == 0xffff:
+        # Resources end where the FCIS, FLIS or DATP section starts. Like
+        # mobi_split, the HUFF table offset field (0x78) is a candidate too.
+        for offset, index in headerIndexes(rec0, (0xC8, 0xD0, 0x100, 0x78)):
+            if 0 < index < lastimage:
+                lastimage = index - 1
+    lastimage = min(lastimage, kf8start - 2)
+    # Empty the KF8-only RESC and FONT sections but keep their places so
+    # image references stay valid.
+    for i in range(firstimage, min(lastimage, len(mobi7))):
+        if not isinstance(mobi7[i], bytes) and sect.loadSection(mobi7[i], 4) in (b'RESC', b'FONT'):
+            mobi7[i] = b''
+
+    # KF8: everything after the BOUNDARY section, with the shared resources
+    # inserted where the KF8 header expects its first one.
+    kfrec0 = sect.loadSection(kf8start).tobytes()
+    count = lastimage - firstimage + 1
+    kf8 = list(range(kf8start, n))
+    target, = struct.unpack_from(b'>L', kfrec0, 0x6C)
+    kf8[target:target] = range(firstimage, lastimage + 1)
+
+    def edit8(records):
+        # Only the last StartOffset (EXTH 116) belongs to the KF8 part. EXTH 125
+        # is the number of resources.
+        last116 = max([i for i, (exth_id, data) in enumerate(records) if exth_id == 116] or [-1])
+        records = [(exth_id, data) for i, (exth_id, data) in enumerate(records) if exth_id != 116 or i == last116]
+        return replaceEXTH(records, 125, struct.pack(b'>L', count))
+    kfrec0 = rewriteEXTH(kfrec0, edit8)
+    flags, = struct.unpack_from(b'>L', kfrec0, 0x80)
+    kfrec0 = setLong(kfrec0, 0x80, (flags & 0x1FFF) | 0x0800)
+    # FDST, FCIS, FLIS and DATP indexes move down past the inserted
+    # resources. Like mobi_split, this shifts every field that is set, and
+    # the HUFF table offset field (0x78) with them, even when it is 0 in a
+    # book that isn't HUFF/CDIC compressed (readers then ignore it).
+    for offset, index in headerIndexes(kfrec0, (0xC0, 0xC8, 0xD0, 0x100, 0x78)):
+        if index != 0xffffffff:
+            kfrec0 = setLong(kfrec0, offset, index + count)
+    kf8[0] = kfrec0
+    return mobi7, kf8
+
+def writePDB(sect, infile, sections, outfile):
+    """ Write a book made of sections (as returned by splitCombo) to outfile.
+        Only the Palm header and section table are built in memory; runs of
+        sections copied from the source go out as single file ranges. """
+    palmheader = bytearray(sect.palmheader)
+    struct.pack_into(b'>L', palmheader, 68, 2*len(sections) + 1)
+    struct.pack_into(b'>H', palmheader, 76, len(sections))
+    gap = max(sect.sectionoffsets[0] - (78 + 8*sect.num_sections), 0)
+    offset = 78 + 8*len(sections) + gap
+    table = []
+    pieces = []
+    for i, section in enumerate(sections):
+        table.append(struct.pack(b'>LL', offset, 2*i))
+        if isinstance(section, bytes):
+            length = len(section)
+            pieces.append(section)
+        else:
+            before, after = sect.sectionoffsets[section:section+2]
+            length = after - before
+            if pieces and isinstance(pieces[-1], tuple) and sum(pieces[-1]) == before:
+                pieces[-1] = (pieces[-1][0], pieces[-1][1] + length)
+            else:
+                pieces.append((before, length))
+        offset += length
+    pieces.insert(0, bytes(palmheader) + b''.join(table) + b'\0' * gap)
+    copyFileRanges(infile, sect.view, pieces, outfile)
 
 
 def makeFileNames(prefix, infile, outdir, kf8=False):
@@ -82,28 +596,79 @@ def makeFileNames(prefix, infile, outdir, kf8=False):
     return os.path.join(outdir, prefix+os.path.splitext(os.path.basename(infile))[0] + '.mobi')
 
 class mobiProcessor:
-    def __init__(self, infile):
+    # A handle on a book: its path plus the probe results below. Nothing is
+    # kept open or in memory between operations; each operation maps the
+    # file itself for as long as it runs, so menus and batch lists can hold
+    # thousands of these cheaply.
+    #
+    # The attributes filled in by probe(), which is all that gets stored in
+    # (and restored from) the probe cache.
+    PROBE_FIELDS = ('ident', 'version', 'isEncrypted', 'isPrintReplica', 'isKF8', 'isComboFile', 'kf8Boundary',
+                    'sourceSection')
+
+    def __init__(self, infile, probe_cache=None, epub_version='2', use_hd=False, prefer_source=False,
+                 parallel_records=0):
         self.infile = infile
-        self.sect = SectionizerLight(self.infile)
-        if (self.sect.ident != b'BOOKMOBI' and self.sect.ident != b'TEXtREAd') or self.sect.ident == 'TPZ':
+        result = probe_cache.get(infile) if probe_cache is not None else None
+        if result is not None:
+            for field in self.PROBE_FIELDS:
+                setattr(self, field, result[field])
+        else:
+            sect = SectionizerLight(self.infile)
+            try:
+                self.probe(sect)
+            finally:
+                sect.close()
+            if probe_cache is not None:
+                probe_cache.put(infile, self.getProbeResult())
+
+        self.hasSource = self.sourceSection != -1
+        self.ePubVersion = epub_version
+        self.useHDImages = use_hd
+        self.preferSource = prefer_source
+        self.parallelRecords = parallel_records
+
+    def probe(self, sect):
+        if (sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd') or sect.ident == 'TPZ':
             raise Exception(_('Unrecognized Kindle/MOBI file format!'))
-        mhl = MobiHeaderLight(self.sect, 0)
+        self.ident = sect.ident.decode('ascii')
+        mhl = MobiHeaderLight(sect, 0)
         self.version = mhl.version
         self.isEncrypted = mhl.isEncrypted()
-        if self.sect.ident == b'TEXtREAd':
+        if sect.ident == b'TEXtREAd':
             self.isPrintReplica = False
             self.isComboFile = False
             self.isKF8 = False
+            self.kf8Boundary = -1
+            self.sourceSection = -1
             return
         self.isPrintReplica = mhl.isPrintReplica()
         self.isKF8 = mhl.isKF8()
-        self.isComboFile = mhl.isJointFile()
+        self.kf8Boundary = mhl.getKF8Boundary()
+        self.isComboFile = self.kf8Boundary != -1
+        self.sourceSection = mhl.getSourceSection()
 
-        self.ePubVersion = cfg.plugin_prefs['Epub_Version']
-        self.useHDImages = cfg.plugin_prefs['Use_HD_Images']
+    def getProbeResult(self):
+        return dict((field, getattr(self, field)) for field in self.PROBE_FIELDS)
+
+    def unpackBook(self, outdir, epubver='2', use_hd=False, output='all'):
+        sect = MappedSectionizer(self.infile)
+        try:
+            unpackBook(sect, self.infile, outdir, epubver, use_hd, self.kf8Boundary, output, self.parallelRecords)
+        finally:
+            sect.close()
 
     def getPDFFile(self, outdir):
-        _mu.unpackBook(self.infile, outdir)
+        sect = MappedSectionizer(self.infile)
+        try:
+            pdf = extractPrintReplicaPDF(sect, self.infile, outdir)
+        except (struct.error, ValueError):
+            pdf = None
+        finally:
+            sect.close()
+        if pdf is not None:
+            return pdf
+        self.unpackBook(outdir)
         files = os.listdir(outdir)
         pdf = ''
         filefilter = re.compile(r'\.pdf$', re.IGNORECASE)
@@ -120,21 +685,100 @@ class mobiProcessor:
             raise Exception(_('Problem locating unpacked pdf: {0}'.format(pdf)))
         return pdf
 
-    def unpackMOBI(self, outdir):
-        _mu.unpackBook(self.infile, outdir, epubver=self.ePubVersion, use_hd=self.useHDImages)
+    def unpackMOBI(self, outdir, output='all'):
+        self.unpackBook(outdir, self.ePubVersion, self.useHDImages, output)
 
-    def unpackEPUB(self, outdir):
-        _mu.unpackBook(self.infile, outdir, epubver=self.ePubVersion, use_hd=self.useHDImages)
-        kf8dir = os.path.join(outdir, 'mobi8')
+    def getSourceArchive(self, outdir):
+        # Copy the kindlegen source zip out of the SRCS section. The first
+        # 16 bytes of the section are its own header.
+        sect = MappedSectionizer(self.infile)
+        try:
+            before, after = sect.sectionoffsets[self.sourceSection:self.sourceSection+2]
+            archive = os.path.join(outdir, os.path.splitext(os.path.basename(self.infile))[0] + '.kindlegensrc.zip')
+            copyFileRanges(self.infile, sect.view, [(before + 16, after - before - 16)], archive)
+        finally:
+            sect.close()
+        return archive
+
+    def getSourceEPUB(self, outdir):
+        # The EPUB kindlegen was given, or None if the source archive isn't one.
+        archive = self.getSourceArchive(outdir)
+        try:
+            epub = os.path.splitext(os.path.splitext(archive)[0])[0] + '.epub'
+            if sourceEPUB(archive, epub):
+                return epub
+        finally:
+            os.remove(archive)
+        return None
+
+    def epubPath(self, outdir):
+        # Where the core puts the ePub it rebuilds when unpacking into outdir.
         kf8BaseName = os.path.splitext(os.path.basename(self.infile))[0]
-        epub = os.path.join(kf8dir, '{0}.epub'.format(kf8BaseName))
-        if not os.path.exists(epub):
-            raise Exception(_('Problem locating unpacked epub: {0}'.format(epub)))
+        return os.path.join(outdir, 'mobi8', '{0}.epub'.format(kf8BaseName))
+
+    def writeEPUB(self, stream):
+        """ Rebuild the ePub from the book's KF8 half straight into stream, a
+            binary file open for writing. The files the core writes along the
+            way are kept in memory (see mobi_epub) rather than in a staging
+            folder. If the core turns out to need them on disk after all, the
+            book is unpacked into a temporary folder instead. """
+        from calibre_plugins.kindleunpack_plugin.mobi_epub import virtual_folder
+        # Never created: everything under it only exists in memory.
+        outdir = os.path.join(tempfile.gettempdir(), 'kindleunpack-{0}'.format(uuid4().hex))
+        start = stream.tell()
+        try:
+            with virtual_folder(outdir) as folder:
+                folder.setOutput(self.epubPath(outdir), stream)
+                self.unpackBook(outdir, self.ePubVersion, self.useHDImages, 'epub')
+            if stream.tell() > start:
+                return
+        except EnvironmentError as e:
+            print('Rebuilding the ePub in memory failed ({0}), unpacking on disk instead'.format(e))
+        stream.seek(start)
+        stream.truncate()
+        tdir = tempfile.mkdtemp(prefix='kindleunpack_')
+        try:
+            self.unpackBook(tdir, self.ePubVersion, self.useHDImages, 'epub')
+            epub = self.epubPath(tdir)
+            if not os.path.exists(epub):
+                raise Exception(_('Problem locating unpacked epub: {0}'.format(epub)))
+            with open(epub, 'rb') as f:
+                shutil.copyfileobj(f, stream)
+        finally:
+            shutil.rmtree(tdir, ignore_errors=True)
+
+    def unpackEPUB(self, outdir):
+        if self.preferSource and self.hasSource:
+            epub = self.getSourceEPUB(outdir)
+            if epub is not None:
+                return epub
+        epub = self.epubPath(outdir)
+        if not os.path.isdir(os.path.dirname(epub)):
+            os.makedirs(os.path.dirname(epub))
+        with open(epub, 'wb') as f:
+            self.writeEPUB(f)
         return epub
 
     def writeSplitCombo(self, outdir):
-        mobi_to_split = mobi_split(unicode_str(self.infile))
         outMobi = makeFileNames('MOBI-', self.infile, outdir)
         outKF8 = makeFileNames('KF8-', self.infile, outdir, True)
-        open(outMobi, 'wb').write(mobi_to_split.getResult7())
-        open(outKF8, 'wb').write(mobi_to_split.getResult8())
+        sect = MappedSectionizer(self.infile)
+        try:
+            if self.kf8Boundary == -1:
+                raise Exception(_('Not a combo KF8/MOBI file.'))
+            mobi7, kf8 = splitCombo(sect, self.kf8Boundary + 1)
+            writePDB(sect, self.infile, mobi7, outMobi)
+            writePDB(sect, self.infile, kf8, outKF8)
+            return outMobi, outKF8
+        except struct.error:
+            # Headers too odd to plan the split from. Let mobi_split have a go.
+            pass
+        finally:
+            sect.close()
+        from calibre_plugins.kindleunpack_plugin.kindleunpackcore.mobi_split import mobi_split
+        mobi_to_split = mobi_split(unicode_str(self.infile))
+        with open(outMobi, 'wb') as f:
+            f.write(mobi_to_split.getResult7())
+        with open(outKF8, 'wb') as f:
+            f.write(mobi_to_split.getResult8())
+        return outMobi, outKF8
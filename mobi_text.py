@@ -0,0 +1,479 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+#####################################################################
+# Text record decompression for the KindleUnpack core.
+#
+# The core decompresses every PalmDoc text record with a pure Python
+# byte loop. calibre ships the same algorithm in C, so when it is
+# available install_backends() swaps it in for the core's reader.
+# Outside calibre (or with an older calibre) the core's own reader
+# stays in place.
+#
+# Text records also decompress independently of each other, so for
+# books with a lot of them (omnibuses, dictionaries) the records can
+# be spread over calibre worker processes and joined back in order.
+#
+# HUFF/CDIC books decode through tables derived from the book's HUFF
+# and CDIC records. Those are built once and cached by content, since
+# books from the same publisher often share them. Inside calibre the
+# built tables are also kept in its cache folder, so that worker
+# processes (which start out empty) load them instead of building them
+# again.
+#####################################################################
+
+import os
+import struct
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+WORKER_MODULE = 'calibre_plugins.kindleunpack_plugin.mobi_text'
+# Number of HUFF/CDIC tables kept around, in memory and on disk. Books
+# from the same publisher often share them, so a batch rarely needs to
+# build more than a few.
+HUFF_CACHE_SIZE = 8
+HUFF_CACHE_DIR = 'kindleunpack_huffcdic'
+
+COMPRESSION_NONE = 1
+COMPRESSION_PALMDOC = 2
+COMPRESSION_HUFFCDIC = 0x4448
+
+
+def native_palmdoc():
+    '''
+    Return calibre's C PalmDoc decompress function, or None if it isn't available.
+    '''
+    try:
+        from calibre.ebooks.compression.palmdoc import decompress_doc
+    except ImportError:
+        return None
+    try:
+        # The module imports fine when the extension failed to build, the
+        # missing extension only shows up once it is called.
+        decompress_doc(b'')
+    except Exception:
+        return None
+    return decompress_doc
+
+
+def palmdoc_valid(data):
+    '''
+    Whether a PalmDoc record is well formed: every literal run lies inside
+    the record, no back reference is cut off by its end, and every back
+    reference points into the text already decompressed. calibre's C
+    decompressor doesn't check any of this, so a malformed record comes
+    out padded with NULs or with bytes from outside its output buffer.
+    '''
+    data = bytearray(data)
+    size = len(data)
+    pos = written = 0
+    while pos < size:
+        c = data[pos]
+        pos += 1
+        if 1 <= c <= 8:
+            pos += c
+            written += c
+            if pos > size:
+                return False
+        elif c < 0x80:
+            written += 1
+        elif c >= 0xC0:
+            written += 2
+        else:
+            if pos >= size:
+                return False
+            distance = ((c << 8 | data[pos]) >> 3) & 0x07ff
+            pos += 1
+            if distance == 0 or distance > written:
+                return False
+            written += (data[pos-1] & 7) + 3
+    return True
+
+
+class NativePalmdocReader:
+    '''
+    Drop-in for the core's mobi_uncompress.PalmdocReader. The C decompressor
+    gives the same output as the core for well formed records (see
+    palmdoc_valid). The rest go through the core's reader, which has its
+    own way of coping with them.
+
+    Checking a record costs about as much as a third of decompressing it in
+    Python, so when unpack is told the size the record should decompress
+    to, the C output is taken as it is whenever it has that size, and only
+    records that come out short or long are checked. A malformed record
+    that happens to come out the right size isn't caught.
+    '''
+    decompress = None
+    fallbackReader = None
+
+    def __init__(self):
+        self.fallback = self.fallbackReader()
+
+    def unpack(self, data, size=None):
+        data = bytes(data)
+        if size is None and not palmdoc_valid(data):
+            return self.fallback.unpack(data)
+        try:
+            text = self.decompress(data)
+        except Exception:
+            return self.fallback.unpack(data)
+        if size is None or len(text) == size or palmdoc_valid(data):
+            return text
+        return self.fallback.unpack(data)
+
+
+def record_sizes(header, count):
+    '''
+    The size each of a PalmDoc book's count text records should decompress
+    to, going by the text length and record size in its record 0 header.
+    '''
+    text_length, = struct.unpack_from(b'>L', header, 4)
+    record_size, = struct.unpack_from(b'>H', header, 10)
+    return [max(0, min(record_size, text_length - i * record_size)) for i in range(count)]
+
+def unpack_records(unpack, records, sizes=None):
+    '''
+    Decompress records with unpack and join them. sizes (see record_sizes)
+    are passed along when unpack is a NativePalmdocReader's.
+    '''
+    if sizes is None or not isinstance(getattr(unpack, '__self__', None), NativePalmdocReader):
+        return b''.join([unpack(data) for data in records])
+    return b''.join([unpack(data, size) for data, size in zip(records, sizes)])
+
+
+class HuffcdicTables:
+    '''
+    Everything needed to decode the text of a HUFF/CDIC book, built once
+    from the core's HuffcdicReader after it has parsed the HUFF and CDIC
+    records. Unless expand is False the dictionary entries are expanded up
+    front rather than on first use. Code lengths are looked up from the top
+    16 bits of a code instead of the top 8, so most codes are resolved
+    without searching the min code table.
+    '''
+    q = struct.Struct(b'>Q').unpack_from
+
+    def __init__(self, reader, expand=True):
+        self.mincode, self.maxcode = reader.mincode, reader.maxcode
+        self.lookup = self.buildLookup(reader.dict1, self.mincode)
+        self.dictionary = list(reader.dictionary)
+        for r in range(len(self.dictionary) if expand else 0):
+            if self.dictionary[r] is not None and not self.dictionary[r][1]:
+                try:
+                    self.expand(r)
+                except Exception:
+                    # The core only trips over a broken entry if the text
+                    # uses it. Leave the entries involved for unpack to do the same.
+                    self.dictionary = [entry or original for entry, original in zip(self.dictionary, reader.dictionary)]
+
+    def buildLookup(self, dict1, mincode):
+        # (codelen, maxcode) for each 16 bit prefix of a code, or (0, None)
+        # for codes longer than 16 bits. Whenever the length is at most 16,
+        # the core's comparisons against mincode only depend on those bits.
+        lookup = []
+        for prefix in range(0x10000):
+            codelen, term, maxcode = dict1[prefix >> 8]
+            if not term:
+                code = prefix << 16
+                while codelen <= 16 and code < mincode[codelen]:
+                    codelen += 1
+                if codelen > 16:
+                    codelen, maxcode = 0, None
+                else:
+                    maxcode = self.maxcode[codelen]
+            lookup.append((codelen, maxcode))
+        return lookup
+
+    def expand(self, r):
+        slice, flag = self.dictionary[r]
+        if not flag:
+            self.dictionary[r] = None
+            slice = self.unpack(slice)
+            self.dictionary[r] = (slice, 1)
+        return slice
+
+    def unpack(self, data):
+        # The core's HuffcdicReader.unpack, reading the table built above.
+        q, lookup, mincode, maxcodes, dictionary = self.q, self.lookup, self.mincode, self.maxcode, self.dictionary
+        bitsleft = len(data) * 8
+        data = data + b'\x00\x00\x00\x00\x00\x00\x00\x00'
+        pos = 0
+        x, = q(data, pos)
+        n = 32
+        out = []
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = q(data, pos)
+                n += 32
+            code = (x >> n) & 0xffffffff
+            codelen, maxcode = lookup[code >> 16]
+            if not codelen:
+                codelen = 17
+                while code < mincode[codelen]:
+                    codelen += 1
+                maxcode = maxcodes[codelen]
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+            r = (maxcode - code) >> (32 - codelen)
+            slice, flag = dictionary[r]
+            if not flag:
+                slice = self.expand(r)
+            out.append(slice)
+        return b''.join(out)
+
+
+_huff_tables = OrderedDict()
+
+def tables_dir():
+    '''
+    The folder built tables are saved in (under calibre's cache folder), or
+    None outside calibre or with a calibre too old to have one.
+    '''
+    try:
+        from calibre.constants import cache_dir
+    except ImportError:
+        return None
+    return os.path.join(cache_dir(), HUFF_CACHE_DIR)
+
+def load_tables(key):
+    folder = tables_dir()
+    if folder is None:
+        return None
+    path = os.path.join(folder, key + '.pickle')
+    try:
+        with open(path, 'rb') as f:
+            tables = pickle.load(f)
+        # The least recently used tables are the first to go (see save_tables).
+        os.utime(path, None)
+    except Exception:
+        return None
+    return tables if isinstance(tables, HuffcdicTables) else None
+
+def save_tables(key, tables):
+    folder = tables_dir()
+    if folder is None:
+        return
+    tmp = None
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # Written under another name first, so that a worker loading the
+        # tables at the same time never sees half of them.
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(tables, f, pickle.HIGHEST_PROTOCOL)
+        path = os.path.join(folder, key + '.pickle')
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+        tmp = None
+        saved = sorted((os.path.getmtime(os.path.join(folder, name)), name)
+                       for name in os.listdir(folder) if name.endswith('.pickle'))
+        for mtime, name in saved[:-HUFF_CACHE_SIZE]:
+            os.remove(os.path.join(folder, name))
+    except EnvironmentError as e:
+        print('Could not save the HUFF/CDIC tables: {0}'.format(e))
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+def huffcdic_tables(huff, cdics, expand=True):
+    '''
+    Return the HuffcdicTables for these HUFF and CDIC records, building them
+    only if no recent book used identical ones. Tables that have to be built
+    are saved for other processes, unless expand is False (see
+    HuffcdicTables), in which case they are only kept in memory.
+    '''
+    digest = hashlib.sha1(huff)
+    for cdic in cdics:
+        digest.update(cdic)
+    key = digest.hexdigest()
+    tables = _huff_tables.pop(key, None)
+    if tables is None:
+        tables = load_tables(key)
+    if tables is None:
+        from calibre_plugins.kindleunpack_plugin.kindleunpackcore.mobi_uncompress import HuffcdicReader
+        reader = HuffcdicReader()
+        reader.loadHuff(huff)
+        for cdic in cdics:
+            reader.loadCdic(cdic)
+        tables = HuffcdicTables(reader, expand)
+        if expand:
+            save_tables(key, tables)
+    while len(_huff_tables) >= HUFF_CACHE_SIZE:
+        _huff_tables.popitem(last=False)
+    _huff_tables[key] = tables
+    return tables
+
+
+class CachedHuffcdicReader:
+    '''
+    Drop-in for the core's mobi_uncompress.HuffcdicReader. The HUFF and CDIC
+    records are only collected here. The tables are fetched from the cache,
+    or built, when the first text record is unpacked. expand is passed on
+    to huffcdic_tables.
+    '''
+    def __init__(self, expand=True):
+        self.huff = None
+        self.cdics = []
+        self.tables = None
+        self.expand = expand
+
+    def loadHuff(self, huff):
+        self.huff = bytes(huff)
+
+    def loadCdic(self, cdic):
+        self.cdics.append(bytes(cdic))
+
+    def unpack(self, data):
+        if self.tables is None:
+            self.tables = huffcdic_tables(self.huff, self.cdics, self.expand)
+        return self.tables.unpack(data)
+
+
+def text_reader(compression, tables):
+    '''
+    Return the unpack function for a PalmDoc or HUFF/CDIC book's text
+    records. tables holds the HUFF and CDIC records of the latter.
+    '''
+    from calibre_plugins.kindleunpack_plugin.kindleunpackcore import mobi_header
+    if compression == COMPRESSION_HUFFCDIC:
+        # A worker only decodes a chunk of the book, which uses a fraction of
+        # the dictionary, so tables it has to build itself aren't expanded
+        # up front. Normally the parent has already saved them (see
+        # mapped_getRawML) and they are just loaded.
+        reader = CachedHuffcdicReader(expand=False)
+        reader.loadHuff(tables[0])
+        for cdic in tables[1:]:
+            reader.loadCdic(cdic)
+        return reader.unpack
+    return mobi_header.PalmdocReader().unpack
+
+def decompress_records(path, compression, table_ranges, ranges, sizes=None):
+    '''
+    Entry point run inside a calibre worker process: decompress the text
+    records at the given (offset, length) ranges of path and return them
+    joined. table_ranges are the ranges of the HUFF/CDIC records, sizes
+    those of the records' text for a PalmDoc book (see record_sizes).
+    '''
+    install_backends()
+    with open(path, 'rb') as f:
+        def read(offset, length):
+            f.seek(offset)
+            return f.read(length)
+        unpack = text_reader(compression, [read(*r) for r in table_ranges])
+        return unpack_records(unpack, (read(*r) for r in ranges), sizes)
+
+def parallel_decompress(path, compression, table_ranges, ranges, sizes=None):
+    '''
+    Decompress the text records at ranges with a pool of calibre worker
+    processes, two chunks of consecutive records per worker. Returns the
+    decompressed text, or None if a worker failed.
+    '''
+    from calibre.utils.ipc.server import Server
+    from calibre.utils.ipc.job import ParallelJob
+    from calibre_plugins.kindleunpack_plugin.jobs import finished_jobs
+    server = Server()
+    pending = {}
+    try:
+        size = max(1, -(-len(ranges) // (2 * server.pool_size)))
+        for n, i in enumerate(range(0, len(ranges), size)):
+            args = [WORKER_MODULE, 'decompress_records', (path, compression, table_ranges, ranges[i:i+size],
+                                                          sizes and sizes[i:i+size])]
+            job = ParallelJob('arbitrary', 'Text records {0}-{1}'.format(i + 1, i + size), done=None, args=args)
+            pending[job] = n
+            server.add_job(job)
+        chunks = [None] * len(pending)
+        while pending:
+            for job in finished_jobs(server, pending, block=True):
+                if job.failed or job.result is None:
+                    print(job.details)
+                    return None
+                chunks[pending.pop(job)] = job.result
+        return b''.join(chunks)
+    finally:
+        for job in pending:
+            server.kill_job(job)
+        server.close()
+
+def mapped_getRawML(getRawML):
+    '''
+    Wrap the core's MobiHeader.getRawML for books mapped by mobi_stuff. The
+    text records are located with MobiHeaderLight.getTextRecordRanges in one
+    pass over the section table instead of the core trimming each record's
+    trailing entries as it goes. A header whose parallelRecords is set (see
+    mobi_stuff.unpackBook) decompresses its text in parallel once it has at
+    least that many text records.
+    '''
+    def wrapper(self):
+        compression, = struct.unpack_from(b'>H', self.header, 0x0)
+        sect = getattr(self.sect, 'mapped', None)
+        if sect is None or compression not in (COMPRESSION_NONE, COMPRESSION_PALMDOC, COMPRESSION_HUFFCDIC):
+            return getRawML(self)
+        from calibre_plugins.kindleunpack_plugin.mobi_stuff import MobiHeaderLight
+        ranges = MobiHeaderLight(sect, self.start).getTextRecordRanges()
+        sizes = record_sizes(self.header, len(ranges)) if compression == COMPRESSION_PALMDOC else None
+        threshold = getattr(self, 'parallelRecords', 0)
+        rawML = None
+        if threshold and self.records >= threshold and compression != COMPRESSION_NONE:
+            table_ranges = []
+            if compression == COMPRESSION_HUFFCDIC:
+                huffoff, huffnum = struct.unpack_from(b'>LL', self.header, 0x70)
+                for i in range(self.start + huffoff, self.start + huffoff + huffnum):
+                    before, after = sect.sectionoffsets[i:i+2]
+                    table_ranges.append((before, after - before))
+                # Built (or loaded) here first, so that the workers all load
+                # the saved tables rather than each building their own.
+                records = [bytes(sect.data[offset:offset+length]) for offset, length in table_ranges]
+                huffcdic_tables(records[0], records[1:])
+            print('Unpacking raw markup language from {0:d} text records in parallel'.format(self.records))
+            rawML = parallel_decompress(sect.filename, compression, table_ranges, ranges, sizes)
+        if rawML is None:
+            print('Unpacking raw markup language')
+            unpack, data = self.unpack, sect.data
+            rawML = unpack_records(unpack, (data[offset:offset+length] for offset, length in ranges), sizes)
+        for i in range(1, self.records + 1):
+            if self.isK8():
+                description = 'KF8 Text Section {0:d}'
+            elif self.version == 0:
+                description = 'PalmDOC Text Section {0:d}'
+            else:
+                description = 'Mobipocket Text Section {0:d}'
+            self.sect.setsectiondescription(self.start + i, description.format(i))
+        self.rawSize = len(rawML)
+        return rawML
+    return wrapper
+
+
+PALMDOC_BACKEND = None
+
+def install_backends():
+    '''
+    Point the core's MobiHeader at the fastest PalmDoc reader available and
+    at the cached HUFF/CDIC tables, and let it decompress large books in
+    parallel. Called by
+    mobi_stuff.unpackCore before the core unpacks anything. Returns the name
+    of the PalmDoc backend in use.
+    '''
+    global PALMDOC_BACKEND
+    if PALMDOC_BACKEND is None:
+        from calibre_plugins.kindleunpack_plugin.kindleunpackcore import mobi_header
+        decompress = native_palmdoc()
+        if decompress is None:
+            PALMDOC_BACKEND = 'python'
+        else:
+            NativePalmdocReader.decompress = staticmethod(decompress)
+            NativePalmdocReader.fallbackReader = mobi_header.PalmdocReader
+            mobi_header.PalmdocReader = NativePalmdocReader
+            PALMDOC_BACKEND = 'calibre'
+        mobi_header.HuffcdicReader = CachedHuffcdicReader
+        mobi_header.MobiHeader.getRawML = mapped_getRawML(mobi_header.MobiHeader.getRawML)
+    return PALMDOC_BACKEND
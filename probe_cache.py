@@ -0,0 +1,149 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import time
+import atexit
+import sqlite3
+from threading import Lock
+
+from calibre.utils.config import config_dir
+
+# Bump whenever the set of probe fields stored by mobiProcessor changes so
+# results written by an older version of the plugin are ignored.
+PROBE_VERSION = 2
+MAX_ENTRIES = 50000
+# A hit only moves an entry up the LRU order if it was last used longer
+# ago than this (in seconds), so re-running a batch doesn't write to the
+# cache for every book.
+TOUCH_AGE = 24 * 60 * 60
+# Hits waiting to be written are written together once there are this many.
+TOUCH_BATCH = 500
+CACHE_FILE = os.path.join(config_dir, 'plugins', 'KindleUnpack_probe_cache.sqlite')
+
+_probe_cache = None
+_probe_cache_lock = Lock()
+
+def get_probe_cache():
+    '''
+    Return the shared ProbeCache, opening it on first use. Returns None if the
+    cache file can't be opened, in which case books are simply probed again.
+    '''
+    global _probe_cache
+    if _probe_cache is None:
+        # The probe threads and the inspection thread can all get here first.
+        with _probe_cache_lock:
+            if _probe_cache is None:
+                try:
+                    _probe_cache = ProbeCache(CACHE_FILE)
+                    # Writes out the hits still waiting to be written.
+                    atexit.register(_probe_cache.close)
+                except (sqlite3.Error, EnvironmentError) as e:
+                    print('KindleUnpack probe cache unavailable: {0}'.format(e))
+                    _probe_cache = False
+    return _probe_cache or None
+
+def file_signature(path):
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_size, mtime_ns
+
+
+class ProbeCache:
+    '''
+    Persistent LRU cache of mobiProcessor probe results keyed by the path,
+    size and modification time of the format file. A file that has changed
+    on disk simply misses and gets probed (and stored) again.
+    '''
+    def __init__(self, filename, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = Lock()
+        # path -> last_used of hits not written yet (see get).
+        self.touched = {}
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.conn = sqlite3.connect(filename, timeout=5, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, '
+                          'mtime INTEGER, version INTEGER, last_used REAL, result TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)')
+        self.conn.commit()
+        self.count, = self.conn.execute('SELECT COUNT(*) FROM probes').fetchone()
+
+    def get(self, path):
+        '''
+        Return the stored probe result for path, or None on a miss.
+        '''
+        try:
+            size, mtime = file_signature(path)
+        except EnvironmentError:
+            return None
+        with self.lock:
+            try:
+                row = self.conn.execute('SELECT result, last_used FROM probes WHERE path=? AND size=? AND mtime=? AND version=?',
+                                        (path, size, mtime, PROBE_VERSION)).fetchone()
+                if row is None:
+                    return None
+                # Entries used recently are left alone. The others are
+                # touched in batches, with the next put or on close.
+                now = time.time()
+                if row[1] < now - TOUCH_AGE:
+                    self.touched[path] = now
+                    if len(self.touched) >= TOUCH_BATCH:
+                        self.write_touched()
+                        self.conn.commit()
+            except sqlite3.Error:
+                return None
+        return json.loads(row[0])
+
+    def put(self, path, result):
+        try:
+            size, mtime = file_signature(path)
+        except EnvironmentError:
+            return
+        with self.lock:
+            try:
+                # Written first so that evict goes by up to date last_used values.
+                self.touched.pop(path, None)
+                self.write_touched()
+                cur = self.conn.execute('UPDATE probes SET size=?, mtime=?, version=?, last_used=?, result=? WHERE path=?',
+                                        (size, mtime, PROBE_VERSION, time.time(), json.dumps(result), path))
+                if cur.rowcount == 0:
+                    self.conn.execute('INSERT INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                                      (path, size, mtime, PROBE_VERSION, time.time(), json.dumps(result)))
+                    self.count += 1
+                    if self.count > self.max_entries:
+                        self.evict()
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print('KindleUnpack probe cache write failed: {0}'.format(e))
+
+    def write_touched(self):
+        if self.touched:
+            self.conn.executemany('UPDATE probes SET last_used=? WHERE path=?',
+                                  [(last_used, path) for path, last_used in self.touched.items()])
+            self.touched = {}
+
+    def evict(self):
+        # Drop the least recently used tenth of the cache in one go rather
+        # than one row per insert once the cap is reached.
+        keep = self.max_entries - self.max_entries // 10
+        self.conn.execute('DELETE FROM probes WHERE path IN (SELECT path FROM probes ORDER BY last_used LIMIT ?)',
+                          (self.count - keep,))
+        self.count = keep
+
+    def close(self):
+        with self.lock:
+            try:
+                self.write_touched()
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print('KindleUnpack probe cache write failed: {0}'.format(e))
+            self.conn.close()
@@ -28,10 +28,17 @@ PLUGIN_DIRS = ['images', 'kindleunpackcore']
 
 PLUGIN_FILES = ['__init__.py',
             'action.py',
+            'api.py',
+            'cli.py',
             'config.py',
             'dialogs.py',
+            'jobs.py',
+            'mobi_epub.py',
+            'mobi_indexes.py',
             'mobi_stuff.py',
+            'mobi_text.py',
             'plugin-import-name-kindleunpack_plugin.txt',
+            'probe_cache.py',
             'utilities.py'
 ]
 
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+'''
+Measure what loading the plugin's GUI action costs at calibre startup.
+
+calibre's interpreter doesn't take -X importtime, so imports are timed in
+process instead, and the report has the same shape: self and cumulative
+time per module that had to be loaded. Run it against an installed copy
+of the plugin (setup.py -d installs one):
+
+    $ calibre-debug -e importtime.py
+
+Exits with 1 if the KindleUnpack core was loaded along with the action
+(it should only be imported on first use), or if the total time is over
+the budget given with --budget MILLISECONDS.
+'''
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import time
+import argparse
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+PLUGIN_NAME = 'KindleUnpack - The Plugin'
+ACTION_MODULE = 'calibre_plugins.kindleunpack_plugin.action'
+CORE_PACKAGE = 'calibre_plugins.kindleunpack_plugin.kindleunpackcore.'
+# Core modules that are small enough to be imported up front.
+CORE_ALLOWED = ('compatibility_utils',)
+
+
+class ImportTimer:
+    '''
+    Wraps __import__ and records (module, self seconds, cumulative seconds)
+    for each module that wasn't loaded yet, like -X importtime does.
+    '''
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.real_import = builtins.__import__
+
+    def __call__(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self.real_import(name, *args, **kwargs)
+        self.stack.append(0.0)
+        start = clock()
+        try:
+            return self.real_import(name, *args, **kwargs)
+        finally:
+            elapsed = clock() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            self.records.append((name, elapsed - children, elapsed))
+
+    def __enter__(self):
+        builtins.__import__ = self
+        return self
+
+    def __exit__(self, *args):
+        builtins.__import__ = self.real_import
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='importtime.py')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Fail if loading the action takes longer than this many milliseconds.')
+    parser.add_argument('--top', type=int, default=25, help='Number of modules to list (default: 25).')
+    opts = parser.parse_args(argv)
+
+    # Makes the installed plugins importable as calibre_plugins.*
+    from calibre.customize.ui import find_plugin
+    if find_plugin(PLUGIN_NAME) is None:
+        print('{0} is not installed.'.format(PLUGIN_NAME))
+        return 2
+
+    loaded_before = set(sys.modules)
+    with ImportTimer() as timer:
+        start = clock()
+        __import__(ACTION_MODULE)
+        total = clock() - start
+
+    print('import time: {0:>10} | {1:>10} | imported package'.format('self [us]', 'cumulative'))
+    for name, self_time, cumulative in sorted(timer.records, key=lambda r: r[2], reverse=True)[:opts.top]:
+        print('import time: {0:>10} | {1:>10} | {2}'.format(int(self_time * 1e6), int(cumulative * 1e6), name))
+    print('\nLoading {0} took {1:.1f} ms and loaded {2} new modules.'.format(
+        ACTION_MODULE, total * 1000, len(set(sys.modules) - loaded_before)))
+
+    failed = False
+    core = sorted(name for name in set(sys.modules) - loaded_before
+                  if name.startswith(CORE_PACKAGE) and name[len(CORE_PACKAGE):] not in CORE_ALLOWED)
+    if core:
+        print('FAIL: the KindleUnpack core was imported at load time: {0}'.format(', '.join(core)))
+        failed = True
+    if opts.budget is not None and total * 1000 > opts.budget:
+        print('FAIL: over the {0:.1f} ms budget.'.format(opts.budget))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main([arg for arg in sys.argv[1:] if arg != '--']))
@@ -0,0 +1,56 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+#####################################################################
+# Makes the plugin's modules importable by the tests.
+#
+# The plugin's __init__ needs calibre, so the source tree is registered
+# as the calibre_plugins.kindleunpack_plugin package without running
+# it. Modules that don't import calibre can then be tested with plain
+# python. The KindleUnpack core is only there once getkucore.py has
+# fetched it; tests that need it are skipped until then. Until then the
+# few helpers mobi_stuff takes from its compatibility_utils are stood
+# in for here, so that probing can still be tested.
+#####################################################################
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'calibre_plugins.kindleunpack_plugin'
+
+if 'calibre_plugins' not in sys.modules:
+    sys.modules['calibre_plugins'] = types.ModuleType(str('calibre_plugins'))
+    sys.modules['calibre_plugins'].__path__ = []
+if PACKAGE not in sys.modules:
+    sys.modules[PACKAGE] = types.ModuleType(str(PACKAGE))
+    sys.modules[PACKAGE].__path__ = [ROOT]
+
+CORE = PACKAGE + '.kindleunpackcore'
+
+def has_core():
+    return os.path.exists(os.path.join(ROOT, 'kindleunpackcore', 'kindleunpack.py'))
+
+def bstr(s):
+    return s.encode('latin-1') if isinstance(s, type('')) else bytes(s)
+
+def unicode_str(p, enc='utf-8'):
+    if p is None or isinstance(p, type('')):
+        return p
+    return p.decode(enc)
+
+
+if not has_core() and CORE not in sys.modules:
+    sys.modules[CORE] = types.ModuleType(str(CORE))
+    sys.modules[CORE].__path__ = []
+    compatibility_utils = types.ModuleType(str(CORE + '.compatibility_utils'))
+    compatibility_utils.PY2 = sys.version_info[0] == 2
+    compatibility_utils.bstr = bstr
+    compatibility_utils.unicode_str = unicode_str
+    sys.modules[compatibility_utils.__name__] = compatibility_utils
+    sys.modules[CORE].compatibility_utils = compatibility_utils
@@ -0,0 +1,133 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+import io
+import os
+import shutil
+import tempfile
+import types
+import unittest
+import warnings
+import zipfile
+
+import plugin_env  # noqa: F401
+from calibre_plugins.kindleunpack_plugin.mobi_epub import patch_module, patch_unipath, virtual_folder
+
+# Stand-ins for the core's unipath and for the way unpack_structure and
+# kindleunpack stage a book and zip it up.
+UNIPATH = '''
+import os
+
+def exists(s):
+    return os.path.exists(s)
+
+def isfile(s):
+    return os.path.isfile(s)
+
+def isdir(s):
+    return os.path.isdir(s)
+
+def mkdir(s):
+    return os.mkdir(s)
+
+def listdir(s):
+    return os.listdir(s)
+'''
+
+CORE = '''
+import os
+import zipfile
+from zipfile import ZipInfo
+
+def build(outdir, resource):
+    for d in (outdir, os.path.join(outdir, 'mobi7'), os.path.join(outdir, 'mobi7', 'Images'),
+              os.path.join(outdir, 'mobi8'), os.path.join(outdir, 'mobi8', 'OEBPS')):
+        if not unipath.exists(d):
+            unipath.mkdir(d)
+    images = os.path.join(outdir, 'mobi7', 'Images')
+    with open(os.path.join(images, 'image00001.jpg'), 'wb') as f:
+        f.write(resource)
+    with open(os.path.join(images, 'font.ttf'), 'wb') as f:
+        f.write(b'font')
+    oebps = os.path.join(outdir, 'mobi8', 'OEBPS')
+    os.mkdir(os.path.join(oebps, 'Images'))
+    for name in unipath.listdir(images):
+        with open(os.path.join(images, name), 'rb') as f:
+            data = f.read()
+        # Left for the garbage collector to close, as the core does.
+        open(os.path.join(oebps, 'Images', name), 'wb').write(data)
+        if name.endswith('.ttf'):
+            os.remove(os.path.join(images, name))
+    with open(os.path.join(oebps, 'content.opf'), 'wb') as f:
+        f.write(b'<package/>')
+    outzip = zipfile.ZipFile(os.path.join(outdir, 'mobi8', 'book.epub'), 'w')
+    outzip.writestr(ZipInfo('mimetype'), b'application/epub+zip')
+    for name in sorted(unipath.listdir(oebps)):
+        path = os.path.join(oebps, name)
+        if unipath.isfile(path):
+            outzip.write(path, os.path.join('OEBPS', name), zipfile.ZIP_DEFLATED)
+        else:
+            for sub in unipath.listdir(path):
+                outzip.write(os.path.join(path, sub), os.path.join('OEBPS', name, sub), zipfile.ZIP_DEFLATED)
+    outzip.close()
+    return unipath.exists(os.path.join(images, 'font.ttf'))
+
+def build_elsewhere(path):
+    with io.open(path, 'wb') as f:
+        f.write(b'x')
+'''
+
+
+def make_module(name, source, **names):
+    module = types.ModuleType(str(name))
+    module.__dict__.update(names)
+    exec(compile(source, name, 'exec'), module.__dict__)
+    return module
+
+
+class VirtualFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.unipath = make_module('unipath', UNIPATH)
+        self.core = make_module('core', CORE, unipath=self.unipath, io=io)
+        patch_unipath(self.unipath)
+        patch_module(self.core, self.unipath)
+        self.tdir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.tdir, 'book')
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+    def test_epub_goes_straight_to_the_stream(self):
+        stream = io.BytesIO()
+        with virtual_folder(self.outdir) as folder:
+            folder.setOutput(os.path.join(self.outdir, 'mobi8', 'book.epub'), stream)
+            self.assertFalse(self.core.build(self.outdir, b'jpeg'))
+        self.assertFalse(os.path.exists(self.outdir))
+        with zipfile.ZipFile(stream) as zf:
+            self.assertEqual(zf.namelist(), ['mimetype', 'OEBPS/Images/font.ttf', 'OEBPS/Images/image00001.jpg',
+                                             'OEBPS/content.opf'])
+            self.assertEqual(zf.read('OEBPS/Images/image00001.jpg'), b'jpeg')
+            self.assertEqual(zf.getinfo('OEBPS/content.opf').compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_same_result_on_disk(self):
+        with warnings.catch_warnings():
+            # The files build leaves open.
+            warnings.simplefilter('ignore')
+            self.assertFalse(self.core.build(self.outdir, b'jpeg'))
+        with zipfile.ZipFile(os.path.join(self.outdir, 'mobi8', 'book.epub')) as zf:
+            self.assertEqual(zf.read('OEBPS/Images/image00001.jpg'), b'jpeg')
+
+    def test_other_routes_to_the_folder_fail(self):
+        with virtual_folder(self.outdir):
+            self.core.build(self.outdir, b'jpeg')
+            self.assertRaises(EnvironmentError, self.core.build_elsewhere, os.path.join(self.outdir, 'mobi8', 'x'))
+        self.assertFalse(os.path.exists(self.outdir))
+
+
+if __name__ == '__main__':
+    unittest.main()
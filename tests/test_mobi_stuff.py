@@ -0,0 +1,79 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+import os
+import shutil
+import struct
+import tempfile
+import tracemalloc
+import unittest
+
+import plugin_env  # noqa: F401
+
+# Upper bound on what each book handle may cost, so that selecting tens of
+# thousands of books doesn't hold their headers or mapped files in memory.
+HANDLE_BYTES = 2048
+HANDLES = 2000
+
+
+def make_mobi(path, text=b'<html><body>Hello</body></html>'):
+    '''
+    Write a minimal uncompressed MOBI 6 book: record 0 and one text record.
+    '''
+    header_length = 0xE8
+    rec0 = bytearray(16 + header_length)
+    struct.pack_into(b'>HHLHHHH', rec0, 0, 1, 0, len(text), 1, 4096, 0, 0)
+    rec0[16:20] = b'MOBI'
+    struct.pack_into(b'>LLLLL', rec0, 20, header_length, 2, 65001, 1, 6)
+    struct.pack_into(b'>L', rec0, 0x68, 6)
+    struct.pack_into(b'>LL', rec0, 0xE0, 0xffffffff, 0)
+    records = [bytes(rec0), text]
+    palm = bytearray(78)
+    palm[:4] = b'test'
+    palm[0x3C:0x44] = b'BOOKMOBI'
+    struct.pack_into(b'>H', palm, 76, len(records))
+    offset = 78 + 8 * len(records) + 2
+    table = b''
+    for i, record in enumerate(records):
+        table += struct.pack(b'>LL', offset, 2 * i)
+        offset += len(record)
+    with open(path, 'wb') as f:
+        f.write(bytes(palm) + table + b'\0\0' + b''.join(records))
+
+
+class MobiProcessorHandleTest(unittest.TestCase):
+
+    def setUp(self):
+        from calibre_plugins.kindleunpack_plugin.mobi_stuff import mobiProcessor
+        self.mobiProcessor = mobiProcessor
+        self.tdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tdir, 'book.mobi')
+        make_mobi(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir, ignore_errors=True)
+
+    def test_handle_keeps_only_path_and_probe_results(self):
+        handle = self.mobiProcessor(self.path)
+        options = {'infile', 'hasSource', 'ePubVersion', 'useHDImages', 'preferSource', 'parallelRecords'}
+        self.assertEqual(set(vars(handle)), set(self.mobiProcessor.PROBE_FIELDS) | options)
+        self.assertFalse(handle.isKF8 or handle.isEncrypted or handle.isPrintReplica)
+
+    def test_handles_stay_small(self):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            handles = [self.mobiProcessor(self.path) for _ in range(HANDLES)]
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(handles), HANDLES)
+        self.assertLess(used / HANDLES, HANDLE_BYTES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__docformat__ = 'restructuredtext en'
+
+import random
+import struct
+import unittest
+
+from plugin_env import has_core
+from calibre_plugins.kindleunpack_plugin.mobi_text import NativePalmdocReader, native_palmdoc, palmdoc_valid, record_sizes, unpack_records
+
+
+def compress(text):
+    '''
+    A simple PalmDoc compressor: back references where the last 2047 bytes
+    repeat at least three bytes, space + character pairs, literal runs.
+    '''
+    text = bytearray(text)
+    out = bytearray()
+    literals = bytearray()
+
+    def flush():
+        for i in range(0, len(literals), 8):
+            run = literals[i:i+8]
+            out.append(len(run))
+            out.extend(run)
+        del literals[:]
+    pos = 0
+    while pos < len(text):
+        best = 0
+        for distance in range(1, min(pos, 2047) + 1):
+            length = 0
+            while length < 10 and pos + length < len(text) and text[pos+length-distance] == text[pos+length]:
+                length += 1
+            if length > best:
+                best, best_distance = length, distance
+        if best >= 3:
+            flush()
+            out.extend(struct.pack(b'>H', 0x8000 | best_distance << 3 | (best - 3)))
+            pos += best
+        elif text[pos] == 0x20 and pos + 1 < len(text) and 0x40 <= text[pos+1] < 0x80:
+            flush()
+            out.append(text[pos+1] ^ 0x80)
+            pos += 2
+        elif 0x09 <= text[pos] < 0x80:
+            flush()
+            out.append(text[pos])
+            pos += 1
+        else:
+            literals.append(text[pos])
+            pos += 1
+    flush()
+    return bytes(out)
+
+def sample_texts(count):
+    rng = random.Random(21)
+    words = [b'the', b'Kindle', b'book', b'\xc3\xa9t\xc3\xa9', b'<p>', b'</p>', b'\x00\x01', b' ', b'  ']
+    return [b' '.join(rng.choice(words) for _ in range(rng.randint(0, 300))) for _ in range(count)]
+
+
+# Records calibre's C decompressor gets wrong: a literal run past the end,
+# a back reference cut off by the end, back references before the start
+# of the text and of distance 0.
+MALFORMED = [b'\x05abc', b'abc\x80', b'\x80\x18', b'ab\x80\xf8', b'abc\x80\x00']
+
+
+class PalmdocValidTest(unittest.TestCase):
+
+    def test_compressed_records_are_valid(self):
+        for text in sample_texts(30):
+            self.assertTrue(palmdoc_valid(compress(text)))
+
+    def test_malformed_records_are_not(self):
+        for record in MALFORMED:
+            self.assertFalse(palmdoc_valid(record), record)
+
+
+class NativePalmdocReaderTest(unittest.TestCase):
+
+    def reader(self, decompress, fallback):
+        class Reader(NativePalmdocReader):
+            pass
+        Reader.decompress = staticmethod(decompress)
+        Reader.fallbackReader = fallback
+        return Reader()
+
+    def test_only_valid_records_reach_native_code(self):
+        seen = []
+
+        class Fallback:
+            def unpack(self, data):
+                return b'fallback'
+        reader = self.reader(lambda data: seen.append(data) or b'native', Fallback)
+        record = compress(b'one two one two one two')
+        self.assertEqual(reader.unpack(memoryview(record)), b'native')
+        self.assertEqual(seen, [record])
+        for record in MALFORMED:
+            self.assertEqual(reader.unpack(record), b'fallback')
+        self.assertEqual(len(seen), 1)
+
+    def test_records_of_the_expected_size_are_not_checked(self):
+        class Fallback:
+            def unpack(self, data):
+                return b'fallback'
+        # Stands in for the C decompressor's output on malformed records.
+        reader = self.reader(lambda data: b'x' * 4096, Fallback)
+        for record in MALFORMED:
+            self.assertEqual(reader.unpack(record, 4096), b'x' * 4096)
+            self.assertEqual(reader.unpack(record, 4000), b'fallback')
+        record = compress(b'one two one two one two')
+        self.assertEqual(reader.unpack(record, 4000), b'x' * 4096)
+
+    def test_record_sizes(self):
+        header = struct.pack(b'>HHLHHHH', 2, 0, 10000, 3, 4096, 0, 0)
+        self.assertEqual(record_sizes(header, 3), [4096, 4096, 1808])
+        # More records than the text length accounts for.
+        self.assertEqual(record_sizes(header, 4), [4096, 4096, 1808, 0])
+
+    def test_unpack_records(self):
+        class Fallback:
+            def unpack(self, data):
+                return data
+        reader = self.reader(lambda data: data.upper(), Fallback)
+        records = [b'ab', b'cd']
+        self.assertEqual(unpack_records(reader.unpack, iter(records), [2, 2]), b'ABCD')
+        self.assertEqual(unpack_records(Fallback().unpack, iter(records), [2, 2]), b'abcd')
+
+    def test_same_output_as_core(self):
+        decompress = native_palmdoc()
+        if decompress is None or not has_core():
+            self.skipTest('needs calibre (run with calibre-debug) and the KindleUnpack core')
+        from calibre_plugins.kindleunpack_plugin.kindleunpackcore.mobi_uncompress import PalmdocReader
+        reader = self.reader(decompress, PalmdocReader)
+        for record in [compress(text) for text in sample_texts(30)] + MALFORMED:
+            self.assertEqual(reader.unpack(record), PalmdocReader().unpack(record), record)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ __docformat__ = 'restructuredtext en'
 
 
 import os
+from collections import deque
 from io import BytesIO as StringIO
 from traceback import print_exc
 
@@ -23,12 +24,16 @@ from calibre.constants import iswindows
 from calibre.gui2 import error_dialog
 from calibre.gui2.actions import menu_action_unique_name
 
-from calibre_plugins.kindleunpack_plugin.mobi_stuff import mobiProcessor
+from calibre_plugins.kindleunpack_plugin.api import probe
+from calibre_plugins.kindleunpack_plugin.config import unpack_options
 from calibre_plugins.kindleunpack_plugin.__init__ import PLUGIN_NAME, PLUGIN_VERSION
 
 plugin_name = None
 plugin_icon_resources = {}
 
+# Number of books probed at the same time by probe_books.
+PROBE_THREADS = 8
+
 def set_plugin_icon_resources(name, resources):
     '''
     Set our global store of plugin name and icon resources for sharing between
@@ -96,7 +101,7 @@ def get_local_images_dir(subfolder=None):
 
 def topaz(f):
     with open(f,'rb') as kindle_file:
-        return (kindle_file.read(3) == str('TPZ'))
+        return (kindle_file.read(3) == b'TPZ')
 
 def showErrorDlg(errmsg, parent, trcbk=False):
     if trcbk:
@@ -177,35 +182,54 @@ def create_menu_action_unique(ia, parent_menu, menu_text, image=None, tooltip=No
             ac.setChecked(True)
     return ac
 
+class SelectionFormats:
+    '''
+    Titles, format lists and format paths for a selection of books. The titles
+    and format lists are fetched for the whole selection in one call each
+    through calibre's new db API. Gathering the kindle formats and checking
+    books in the ProgressDialog both use them. Paths are looked up only for
+    the formats that are actually inspected.
+    '''
+    def __init__(self, db, book_ids):
+        self.db = db.new_api
+        self.titles = self.db.all_field_for('title', book_ids)
+        self.formats = self.db.all_field_for('formats', book_ids)
+
+    def title(self, book_id):
+        return self.titles.get(book_id) or _('Unknown')
+
+    def get_formats(self, book_id):
+        return list(self.formats.get(book_id) or ())
+
+    def format_path(self, book_id, format):
+        # None if the format has no file on disk.
+        return self.db.format_abspath(book_id, format)
+
+
 class KindleFormats:
     '''
     Build dictionary of details about kindle formats (and what formats they will be converted to).
     '''
-    def __init__(self, book_id, db, target_formats, goal_format):
-        self.book_id, self.db, self.target_formats, self.goal_format = book_id, db, target_formats, goal_format
+    def __init__(self, book_id, selection, target_formats, goal_format):
+        self.book_id, self.selection, self.target_formats, self.goal_format = book_id, selection, target_formats, goal_format
         self.__kindle_formats = {}
 
     def get_formats(self):
         if len(self.__kindle_formats):
             return self.__kindle_formats
-        all_formats = self.db.formats(self.book_id, index_is_id=True, verify_formats=True)
-        if all_formats is not None:
-            all_formats = all_formats.split(',')
-        else:
-            all_formats = []
-        for format in all_formats:
+        for format in self.selection.get_formats(self.book_id):
             if format in self.target_formats:
-                self.__kindle_formats[format] = KindleFormatDetails(format, self.book_id, self.db, self.goal_format)
+                self.__kindle_formats[format] = KindleFormatDetails(format, self.book_id, self.selection, self.goal_format)
         return self.__kindle_formats
 
 
 class KindleFormatDetails:
     '''
     Build dictionary of errors accessing the internals of the kindlebook through the mobiProcessor object.
-    Include the initialized mobiProcessor object (from mobi_stuff.py) as well.
+    Include the initialized mobiProcessor object (from api.probe) as well.
     '''
-    def __init__(self, format, book_id, db, goal_format):
-        self.format, self.book_id, self.db, self.goal_format = format, book_id, db, goal_format
+    def __init__(self, format, book_id, selection, goal_format):
+        self.format, self.book_id, self.selection, self.goal_format = format, book_id, selection, goal_format
         self.__details = {}
 
     def get_format_details(self):
@@ -213,22 +237,100 @@ class KindleFormatDetails:
             return self.__details
         self.__details['errors'] = None
         self.__details['goal_format'] = self.goal_format
-        path = self.db.format_abspath(self.book_id, self.format, index_is_id=True) or None
+        path = self.selection.format_path(self.book_id, self.format) or None
         self.__details['path'] = path
         if path is None:
             self.__details['errors'] = 'path'
             return self.__details
-        elif topaz(path):
-            self.__details['errors'] = 'topaz'
-            return self.__details
+        # Not imported up front so sqlite3 isn't loaded along with the plugin.
+        from calibre_plugins.kindleunpack_plugin.probe_cache import get_probe_cache
         try:
-            mobi = mobiProcessor(path)
+            mobi = probe(path, get_probe_cache(), **unpack_options())
         except Exception as e:
-            self.__details['errors'] = str(e)
+            # Only worth opening the file again to find out why once the probe has failed.
+            self.__details['errors'] = 'topaz' if topaz(path) else str(e)
             return self.__details
         self.__details['kindle_obj'] = mobi
         return self.__details
 
+def probe_books(books_info, threads=PROBE_THREADS, skip=None):
+    '''
+    Yield each (book_id, title, format_dict) of books_info (as built by
+    gatherKindleFormats), in order, once the details of all its kindle
+    formats have been worked out. Up to two books per thread are probed
+    ahead of the consumer on a pool of threads. Probing is mostly waiting
+    on the header reads, which release the GIL, so on slow or network
+    storage the waits overlap instead of adding up. Books for which
+    skip(book_info) is true are passed through without being probed.
+    '''
+    def inspect(book_info):
+        if skip is not None and skip(book_info):
+            return book_info
+        try:
+            for format_obj in book_info[2].values():
+                format_obj.get_format_details()
+        except Exception:
+            # Left for the consumer to run into (and report) again.
+            print_exc()
+        return book_info
+
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        # Python 2 calibre without the futures backport. Probe serially.
+        ThreadPoolExecutor = None
+    if ThreadPoolExecutor is None or threads < 2:
+        for book_info in books_info:
+            yield inspect(book_info)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for book_info in books_info:
+            pending.append(executor.submit(inspect, book_info))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Outcomes of classify_book, in the order an analysis reports them.
+OUTCOMES = ('eligible', 'exists', 'encrypted', 'topaz', 'not_eligible', 'missing_file', 'invalid', 'no_format')
+
+def precheck_book(book_info, target_format, selection):
+    '''
+    The outcome of classify_book that can be told from the library's format
+    lists alone, without opening the book. None if the book has to be probed.
+    '''
+    book_id, format_dict = book_info[0], book_info[2]
+    if target_format not in format_dict:
+        return 'no_format'
+    if format_dict[target_format].goal_format in selection.get_formats(book_id):
+        return 'exists'
+    return None
+
+def classify_book(book_info, target_format, attr, selection):
+    '''
+    Work out what a multiple book action would do with a book gathered by
+    gatherKindleFormats. Returns an (outcome, kindle_obj) tuple, outcome being
+    one of OUTCOMES. kindle_obj is None unless the book is eligible.
+    '''
+    outcome = precheck_book(book_info, target_format, selection)
+    if outcome is not None:
+        return outcome, None
+    details = book_info[2][target_format].get_format_details()
+    if details['errors'] == 'path':
+        return 'missing_file', None
+    if details['errors'] == 'topaz':
+        return 'topaz', None
+    if details['errors'] is not None:
+        return 'invalid', None
+    kindle_obj = details['kindle_obj']
+    if kindle_obj.isEncrypted:
+        return 'encrypted', None
+    if not getattr(kindle_obj, attr):
+        return 'not_eligible', None
+    return 'eligible', kindle_obj
+
 def build_log(failures, successes, target, goal, name):
     NOFORMAT = ENCRYPTED = NOSPECIAL = UNKNOWN = EXISTS = 0
     NOFORMAT_titles, ENCRYPTED_titles, NOSPECIAL_titles, UNKNOWN_titles, EXISTS_titles = [], [], [], [], []